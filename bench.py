@@ -0,0 +1,486 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import threading
+from contextlib import contextmanager
+from itertools import product
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+import bot
+import metrics
+from cache import decoded_audio_cache
+from model import RawTextAudioCollection, RawTextAudioEntry, result_cache
+
+
+# codec -> (file extension, ffmpeg arguments) of the generated audio
+CODECS = {
+    'aac': ('.m4a', ['-c:a', 'aac']),
+    'alac': ('.m4a', ['-c:a', 'alac']),
+    'mp3': ('.mp3', ['-c:a', 'libmp3lame']),
+    'flac': ('.flac', ['-c:a', 'flac']),
+    'wav': ('.wav', ['-c:a', 'pcm_s16le']),
+}
+
+DEFAULT_ENTRIES = 100
+DEFAULT_DURATIONS = (0.5, 2.0, 5.0)
+DEFAULT_RATES = (22050, 44100, 48000)
+DEFAULT_CODECS = ('aac', 'mp3', 'flac')
+# distinct clips generated with ffmpeg, the entries link to them in turn
+DEFAULT_CLIPS = 27
+DEFAULT_INGEST_FILES = 50
+DEFAULT_SELECTIONS = (2, 10, 50)
+DEFAULT_CONCAT_EXTS = ('.m4a', '.mp3')
+DEFAULT_QUEUE_QUERIES = 20
+DEFAULT_QUEUE_CHATS = 4
+DEFAULT_REPEAT = 3
+DEFAULT_SEED = 1
+
+# a benchmark is a regression when its median is this much slower than the baseline's
+DEFAULT_THRESHOLD = 0.1
+# and at least this many seconds slower, so that tiny timings don't flag noise
+DEFAULT_MIN_DELTA_SECS = 0.005
+
+QUEUE_TIMEOUT_SECS = 600
+
+RESULTS_VERSION = 1
+
+CLIPS_DIR = 'clips'
+SOURCES_DIR = 'sources'
+TREE_DIR = 'tree'
+RUNS_DIR = 'runs'
+
+
+class BenchError(Exception):
+    def __init__(self, details):
+        super().__init__(f'Benchmark failed: {details}')
+
+
+@contextmanager
+def working_dir(path):
+    """Runs the block in the directory, the model resolves res/ against it."""
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def generate_clip(path: str, duration: float, rate: int, codec: str, frequency: int) -> None:
+    """Writes a sine tone with ffmpeg."""
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'sine=frequency={frequency}:duration={duration}:sample_rate={rate}',
+        '-ac', '1',
+        *CODECS[codec][1],
+        path
+    ]
+    try:
+        proc = subprocess.run(cmd, capture_output=True)
+    except OSError as e:
+        raise BenchError(f'couldn\'t run ffmpeg: {e}') from e
+    if proc.returncode != 0:
+        raise BenchError(proc.stderr.decode('utf8', errors='replace').strip())
+
+
+def generate_tree(dir: str, entries=DEFAULT_ENTRIES, durations=DEFAULT_DURATIONS, rates=DEFAULT_RATES,
+                  codecs=DEFAULT_CODECS, clips=DEFAULT_CLIPS, ingest_files=DEFAULT_INGEST_FILES,
+                  seed=DEFAULT_SEED) -> dict:
+    """Generates a synthetic tree in dir and returns its parameters.
+
+    dir/tree/res holds the entries, linked to a few distinct clips cycling through every
+    combination of the durations, sample rates and codecs. dir/sources holds plain audio
+    files for the ingest benchmark.
+    """
+    rng = random.Random(seed)
+    variants = list(product(durations, rates, codecs))
+    clips_dir = os.path.join(dir, CLIPS_DIR)
+    os.makedirs(clips_dir, exist_ok=True)
+    clip_paths = []
+    for i in range(max(min(clips, entries), 1)):
+        duration, rate, codec = variants[i % len(variants)]
+        path = os.path.join(clips_dir, f'{seed}-{i:03d}-{duration}s-{rate}hz-{codec}{CODECS[codec][0]}')
+        if not os.path.exists(path):
+            generate_clip(path, duration, rate, codec, rng.randrange(200, 2000))
+        clip_paths.append(path)
+    logging.info(f'Generated {len(clip_paths)} clips in {clips_dir}.')
+
+    res_dir = os.path.join(dir, TREE_DIR, 'res')
+    sources_dir = os.path.join(dir, SOURCES_DIR)
+    for path in (res_dir, sources_dir):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+    with working_dir(os.path.join(dir, TREE_DIR)):
+        for i in range(entries):
+            clip_path = clip_paths[i % len(clip_paths)]
+            name = f'e{i:06d}'
+            audio_path = os.path.join('res', f'{name}{os.path.splitext(clip_path)[1]}')
+            link_or_copy(clip_path, audio_path)
+            RawTextAudioEntry(name, audio_path).save()
+    for i in range(min(ingest_files, entries)):
+        clip_path = clip_paths[i % len(clip_paths)]
+        link_or_copy(clip_path, os.path.join(sources_dir, f's{i:06d}{os.path.splitext(clip_path)[1]}'))
+    logging.info(f'Generated {entries} entries in {res_dir}.')
+    return {
+        'entries': entries,
+        'durations': list(durations),
+        'rates': list(rates),
+        'codecs': list(codecs),
+        'clips': len(clip_paths),
+        'ingest_files': min(ingest_files, entries),
+        'seed': seed,
+    }
+
+
+def measure(func: Callable[[], Optional[dict]], repeat: int, setup: Callable[[], None] = None) -> dict:
+    """Runs func repeat times, after setup every time, and summarizes how long it took.
+
+    func can return extra figures of the run; the ones of the last run are kept.
+    """
+    runs = []
+    extra = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        extra = func()
+        runs.append(time.perf_counter() - start)
+    result = {
+        'runs': [round(secs, 6) for secs in runs],
+        'median': round(statistics.median(runs), 6),
+        'min': round(min(runs), 6),
+        'mean': round(statistics.mean(runs), 6),
+    }
+    if extra:
+        result.update(extra)
+    return result
+
+
+def bench_load(dir: str, repeat: int, entries: int) -> Dict[str, dict]:
+    def load():
+        RawTextAudioCollection()
+
+    def load_lazy():
+        RawTextAudioCollection(lazy=True)
+
+    with working_dir(os.path.join(dir, TREE_DIR)):
+        return {
+            f'load[entries={entries}]': measure(load, repeat),
+            f'load_lazy[entries={entries}]': measure(load_lazy, repeat),
+        }
+
+
+def bench_ingest(dir: str, repeat: int, workers: int) -> Dict[str, dict]:
+    sources_dir = os.path.join(dir, SOURCES_DIR)
+    files = len(os.listdir(sources_dir))
+    run_dir = os.path.join(dir, RUNS_DIR, 'ingest')
+
+    def setup():
+        # ingest converts the files in place, so every run gets a fresh copy
+        if os.path.exists(run_dir):
+            shutil.rmtree(run_dir)
+        os.makedirs(run_dir)
+        shutil.copytree(sources_dir, os.path.join(run_dir, 'res'))
+
+    def run():
+        with working_dir(run_dir):
+            stats = RawTextAudioCollection(lazy=True).init_audio_dir(workers=workers)
+        if stats['failed']:
+            raise BenchError(f'couldn\'t ingest {stats["failed"]}')
+        return {'files_per_sec': stats['files_per_sec'], 'mb_per_sec': stats['mb_per_sec']}
+
+    result = measure(run, repeat, setup)
+    shutil.rmtree(run_dir)
+    return {f'init_audio_dir[files={files},workers={workers}]': result}
+
+
+def bench_concat(dir: str, repeat: int, selections, exts, workers: Optional[int], seed: int) -> Dict[str, dict]:
+    rng = random.Random(seed)
+    out_dir = os.path.join(dir, RUNS_DIR, 'concat')
+    os.makedirs(out_dir, exist_ok=True)
+    results = {}
+    with working_dir(os.path.join(dir, TREE_DIR)):
+        model = RawTextAudioCollection(lazy=True)
+        names = sorted(model.keys())
+        for n, ext in product(selections, exts):
+            selection = rng.sample(names, min(n, len(names)))
+            output_path = os.path.join(out_dir, f'concat{n}{ext}')
+
+            def setup():
+                # every run starts cold
+                result_cache.invalidate(selection)
+                decoded_audio_cache.clear()
+
+            results[f'concat_audio[n={len(selection)},ext={ext}]'] = measure(
+                lambda: model.concat_audio(output_path, selection, workers=workers), repeat, setup
+            )
+        # the other benchmarks start without cached results
+        result_cache.invalidate(names)
+    shutil.rmtree(out_dir)
+    return results
+
+
+class FakeBot:
+
+    """Stands in for telegram.Bot: counts the messages and documents the bot sends."""
+
+    def __init__(self, sources_dir):
+        self.sources_dir = sources_dir
+        self.messages = 0
+        self.documents = 0
+        self._cond = threading.Condition()
+        self._file_ids = 0
+
+    def send_message(self, chat_id, text):
+        with self._cond:
+            self.messages += 1
+
+    def send_document(self, chat_id, document):
+        with self._cond:
+            self.documents += 1
+            self._file_ids += 1
+            self._cond.notify_all()
+            return SimpleNamespace(document=SimpleNamespace(file_id=f'file{self._file_ids}'))
+
+    def get_file(self, file_id):
+        source_path = os.path.join(self.sources_dir, file_id)
+        return SimpleNamespace(download=lambda path: shutil.copyfile(source_path, path))
+
+    def wait_documents(self, count, timeout=QUEUE_TIMEOUT_SECS) -> None:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.documents >= count, timeout):
+                raise BenchError(f'only {self.documents} of {count} documents were sent in {timeout}s')
+
+
+def bench_queue(dir: str, repeat: int, queries: int, chats: int, query_size: int, seed: int) -> Dict[str, dict]:
+    sources_dir = os.path.join(dir, SOURCES_DIR)
+    sources = sorted(os.listdir(sources_dir))
+    run_dir = os.path.join(dir, RUNS_DIR, 'queue')
+
+    def setup():
+        if os.path.exists(run_dir):
+            shutil.rmtree(run_dir)
+        shutil.copytree(os.path.join(dir, TREE_DIR), run_dir)
+        # cached results and the ids of uploaded files would skip the concatenation
+        shutil.rmtree(os.path.join(run_dir, 'res', '.cache'), ignore_errors=True)
+        with working_dir(run_dir):
+            bot.model = RawTextAudioCollection(lazy=True, pack_audio=True)
+            bot.file_ids = bot.FileIdStore()
+        bot.queues = {}
+        bot.missing_index = bot.MissingIndex()
+
+    def run():
+        rng = random.Random(seed)
+        fake_bot = FakeBot(sources_dir)
+        with working_dir(run_dir):
+            names = sorted(bot.model.keys())
+            # every other query waits for an entry that arrives later
+            missing = [f'new{i:03d}' for i in range(queries // 2)]
+            start = time.perf_counter()
+            for i in range(queries):
+                query = rng.sample(names, min(query_size, len(names)))
+                if i % 2:
+                    query.append(missing[i // 2])
+                bot.get_queue(fake_bot, i % chats).add(query)
+            add_secs = time.perf_counter() - start
+            start = time.perf_counter()
+            for i, name in enumerate(missing):
+                update = SimpleNamespace(
+                    message=SimpleNamespace(audio=SimpleNamespace(title=name, file_id=sources[i % len(sources)])),
+                    effective_chat=SimpleNamespace(id=i % chats)
+                )
+                bot.add_audio(update, SimpleNamespace(bot=fake_bot))
+            update_secs = time.perf_counter() - start
+            fake_bot.wait_documents(queries)
+            bot.get_scheduler().shutdown()
+            bot.scheduler = None
+        return {
+            'adds_per_sec': round(queries / add_secs, 1) if add_secs else 0.0,
+            'updates_per_sec': round(len(missing) / update_secs, 1) if update_secs else 0.0,
+        }
+
+    result = measure(run, repeat, setup)
+    shutil.rmtree(run_dir)
+    return {f'audio_queue[queries={queries},chats={chats},size={query_size}]': result}
+
+
+def ffmpeg_version() -> Optional[str]:
+    try:
+        proc = subprocess.run(['ffmpeg', '-version'], capture_output=True)
+    except OSError:
+        return None
+    return proc.stdout.decode('utf8', errors='replace').split('\n', 1)[0]
+
+
+def run(args) -> dict:
+    os.makedirs(args.dir, exist_ok=True)
+    dir = os.path.abspath(args.dir)
+    params = generate_tree(
+        dir, args.entries, args.durations, args.rates, args.codecs, args.clips, args.ingest_files, args.seed
+    )
+    # the stage timings tell where the time of the benchmarks goes
+    metrics.enable()
+    metrics.registry.reset()
+    benchmarks = {}
+    if 'load' in args.only:
+        benchmarks.update(bench_load(dir, args.repeat, args.entries))
+    if 'ingest' in args.only:
+        benchmarks.update(bench_ingest(dir, args.repeat, args.workers))
+    if 'concat' in args.only:
+        benchmarks.update(bench_concat(dir, args.repeat, args.selections, args.exts, args.concat_workers, args.seed))
+    if 'queue' in args.only:
+        benchmarks.update(bench_queue(
+            dir, args.repeat, args.queue_queries, args.queue_chats, args.selections[0], args.seed
+        ))
+    for name, result in benchmarks.items():
+        logging.info(f'{name}: median {result["median"]}s')
+    return {
+        'version': RESULTS_VERSION,
+        'created': time.time(),
+        'env': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'ffmpeg': ffmpeg_version(),
+        },
+        'params': {**params, 'repeat': args.repeat, 'workers': args.workers},
+        'benchmarks': benchmarks,
+        'stages': metrics.snapshot()['timings'],
+    }
+
+
+def compare(baseline: dict, results: dict, threshold=DEFAULT_THRESHOLD, min_delta=DEFAULT_MIN_DELTA_SECS) -> List[dict]:
+    """Compares the medians of the benchmarks with the baseline's.
+
+    Every benchmark gets a status: regression, improvement, ok, new (not in the baseline)
+    or missing (only in the baseline).
+    """
+    rows = []
+    base_benchmarks, benchmarks = baseline['benchmarks'], results['benchmarks']
+    for name in sorted(base_benchmarks.keys() | benchmarks.keys()):
+        if name not in benchmarks:
+            rows.append({'name': name, 'status': 'missing'})
+            continue
+        if name not in base_benchmarks:
+            rows.append({'name': name, 'status': 'new', 'median': benchmarks[name]['median']})
+            continue
+        base, current = base_benchmarks[name]['median'], benchmarks[name]['median']
+        ratio = current / base if base else float('inf')
+        status = 'ok'
+        if abs(current - base) >= min_delta:
+            if ratio > 1 + threshold:
+                status = 'regression'
+            elif ratio < 1 - threshold:
+                status = 'improvement'
+        rows.append({'name': name, 'status': status, 'baseline': base, 'median': current, 'ratio': round(ratio, 3)})
+    return rows
+
+
+def print_comparison(rows: List[dict]) -> None:
+    for row in rows:
+        if 'ratio' in row:
+            print(f'{row["status"]:<12} {row["name"]}: {row["baseline"]}s -> {row["median"]}s (x{row["ratio"]})')
+        else:
+            print(f'{row["status"]:<12} {row["name"]}')
+
+
+def read_results(path: str) -> dict:
+    with open(path, encoding='utf8') as results_fd:
+        return json.load(results_fd)
+
+
+def write_results(results: dict, path: Optional[str]) -> None:
+    results_json = json.dumps(results, indent=2)
+    if path:
+        with open(path, 'w', encoding='utf8') as results_fd:
+            results_fd.write(results_json)
+    else:
+        print(results_json)
+
+
+def comma_separated(type):
+    return lambda value: tuple(type(item) for item in value.split(',') if item)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the model on synthetic audio trees.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='generate a tree, run the benchmarks and write JSON results')
+    run_parser.add_argument('--dir', default='bench', help='where the synthetic tree is generated')
+    run_parser.add_argument('--entries', type=int, default=DEFAULT_ENTRIES, help='number of entries in the tree')
+    run_parser.add_argument('--durations', type=comma_separated(float), default=DEFAULT_DURATIONS,
+                            help='durations of the clips in seconds, comma-separated')
+    run_parser.add_argument('--rates', type=comma_separated(int), default=DEFAULT_RATES,
+                            help='sample rates of the clips, comma-separated')
+    run_parser.add_argument('--codecs', type=comma_separated(str), default=DEFAULT_CODECS,
+                            help=f'codecs of the clips, comma-separated, out of {", ".join(CODECS)}')
+    run_parser.add_argument('--clips', type=int, default=DEFAULT_CLIPS,
+                            help='number of distinct clips the entries are made of')
+    run_parser.add_argument('--ingest-files', type=int, default=DEFAULT_INGEST_FILES,
+                            help='number of files ingested by the init_audio_dir benchmark')
+    run_parser.add_argument('--selections', type=comma_separated(int), default=DEFAULT_SELECTIONS,
+                            help='numbers of entries concatenated, comma-separated')
+    run_parser.add_argument('--exts', type=comma_separated(str), default=DEFAULT_CONCAT_EXTS,
+                            help='extensions of the concatenated audio, comma-separated')
+    run_parser.add_argument('--queue-queries', type=int, default=DEFAULT_QUEUE_QUERIES,
+                            help='number of queries sent to the bot queue')
+    run_parser.add_argument('--queue-chats', type=int, default=DEFAULT_QUEUE_CHATS,
+                            help='number of chats the queries come from')
+    run_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='ingest worker processes')
+    run_parser.add_argument('--concat-workers', type=int, help='concatenation decoding worker processes')
+    run_parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='runs of every benchmark')
+    run_parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    run_parser.add_argument('--only', type=comma_separated(str), default=('load', 'ingest', 'concat', 'queue'),
+                            help='benchmarks to run, comma-separated')
+    run_parser.add_argument('--output', metavar='FILE', help='where the JSON results are written, stdout by default')
+    run_parser.add_argument('--baseline', metavar='FILE', help='compare the results with these ones')
+
+    compare_parser = subparsers.add_parser('compare', help='compare JSON results with a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+
+    for subparser in (run_parser, compare_parser):
+        subparser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                               help='relative slowdown of a median that is a regression')
+        subparser.add_argument('--min-delta', type=float, default=DEFAULT_MIN_DELTA_SECS,
+                               help='smaller slowdowns in seconds are never regressions')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.command == 'run':
+        results = run(args)
+        write_results(results, args.output)
+        if not args.baseline:
+            return 0
+        baseline = read_results(args.baseline)
+    else:
+        baseline, results = read_results(args.baseline), read_results(args.results)
+    if baseline.get('params') != results.get('params'):
+        logging.warning('The results were made with other parameters than the baseline.')
+    rows = compare(baseline, results, args.threshold, args.min_delta)
+    print_comparison(rows)
+    return 1 if any(row['status'] == 'regression' for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import os
+import json
+import logging
+import threading
+from typing import Iterable, List, Set, Tuple
+
+from pcmstore import FileLock
+
+
+REFS_FILE_NAME = 'refs.json'
+
+LOCK_EXT = '.lock'
+
+
+class BlobStore:
+
+    """Canonical audio stored once per content hash and shared by all the entries (aliases) made of it.
+
+    Every blob counts the names of its aliases; it's deleted together with the last of them.
+    The GUI, the CLI and the bot can share the store: every change re-reads the refs under
+    an exclusive file lock.
+    """
+
+    def __init__(self, dir, ext):
+        self.dir = dir
+        self.ext = ext
+        self.refs_path = os.path.join(dir, REFS_FILE_NAME)
+        self.lock_path = f'{self.refs_path}{LOCK_EXT}'
+        self._refs = {}  # content hash -> names of the aliases, as of the last read
+        self._lock = threading.Lock()
+
+    def _load(self) -> None:
+        self._refs = {}
+        if os.path.exists(self.refs_path):
+            with open(self.refs_path, encoding='utf8') as refs_fd:
+                self._refs = {content_hash: set(names) for content_hash, names in json.load(refs_fd).items()}
+
+    def _save(self) -> None:
+        with open(f'{self.refs_path}.tmp', 'w', encoding='utf8') as refs_fd:
+            json.dump({content_hash: sorted(names) for content_hash, names in self._refs.items()}, refs_fd)
+        os.replace(f'{self.refs_path}.tmp', self.refs_path)
+
+    def _locked(self) -> FileLock:
+        """Locks the store against other processes, the refs have to be read again inside."""
+        os.makedirs(self.dir, exist_ok=True)
+        return FileLock(self.lock_path)
+
+    def path(self, content_hash: str) -> str:
+        return os.path.join(self.dir, f'{content_hash}{self.ext}')
+
+    def add(self, content_hash: str, audio_path: str, name: str) -> str:
+        """Makes the audio file a blob unless there is one with the same content already.
+
+        The file is moved into the store or removed. Returns the path of the blob.
+        """
+        return self.add_many([(content_hash, audio_path, name)])[0]
+
+    def add_many(self, items: Iterable[Tuple[str, str, str]]) -> List[str]:
+        """Adds (content hash, audio path, name) items reading and writing the refs once, returns the blob paths."""
+        paths = []
+        with self._lock, self._locked():
+            self._load()
+            for content_hash, audio_path, name in items:
+                path = self.path(content_hash)
+                if os.path.exists(path):
+                    logging.debug(f'M: {name} has the same audio as {sorted(self._refs.get(content_hash, ()))}.')
+                    os.remove(audio_path)
+                else:
+                    os.replace(audio_path, path)
+                self._refs.setdefault(content_hash, set()).add(name)
+                paths.append(path)
+            if paths:
+                self._save()
+        return paths
+
+    def release(self, content_hash: str, name: str) -> bool:
+        """Drops an alias of the blob, deletes the blob if it was the last one. Returns whether it was."""
+        return bool(self.release_many([(content_hash, name)]))
+
+    def release_many(self, items: Iterable[Tuple[str, str]]) -> Set[str]:
+        """Drops (content hash, name) aliases reading and writing the refs once, returns the hashes of deleted blobs."""
+        deleted = set()
+        with self._lock, self._locked():
+            self._load()
+            released = False
+            for content_hash, name in items:
+                released = True
+                names = self._refs.get(content_hash, set())
+                names.discard(name)
+                if not names:
+                    self._refs.pop(content_hash, None)
+                    if os.path.exists(self.path(content_hash)):
+                        os.remove(self.path(content_hash))
+                    deleted.add(content_hash)
+            if released:
+                self._save()
+        return deleted
+
+    def rename(self, content_hash: str, name: str, new_name: str) -> None:
+        with self._lock, self._locked():
+            self._load()
+            names = self._refs.setdefault(content_hash, set())
+            names.discard(name)
+            names.add(new_name)
+            self._save()
+
+    def aliases(self, content_hash: str) -> Set[str]:
+        with self._lock:
+            # the refs are replaced atomically, so reading them doesn't need the file lock
+            self._load()
+            return set(self._refs.get(content_hash, ()))
+
+    def stats(self) -> dict:
+        """Returns the numbers of blobs and aliases."""
+        with self._lock:
+            self._load()
+            return {
+                'blobs': len(self._refs),
+                'aliases': sum(len(names) for names in self._refs.values()),
+            }
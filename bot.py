@@ -1,11 +1,18 @@
 import os
+import json
 import queue
-import subprocess
-from collections import deque
+import logging
+import threading
+import time
+from collections import deque, defaultdict, OrderedDict
 
 from telegram.ext import *
+from telegram.error import TelegramError
 
-from model import RawTextAudioCollection
+import metrics
+from model import RawTextAudioCollection, CACHE_FOLDER_PATH
+from concat import ExportError
+from ingest import IngestError
 from util import default_audio_name
 from deniqq import deniqq
 
@@ -13,13 +20,24 @@ from deniqq import deniqq
 TELEGRAM_TOKEN_VARNAME = 'TGTOKEN'
 TOKEN = os.environ.get(TELEGRAM_TOKEN_VARNAME)
 
+# concatenation mostly waits for ffmpeg and copies buffers, so threads are enough
+CONCAT_WORKERS = os.cpu_count() or 1
+
+FILE_IDS_PATH = os.path.join(CACHE_FOLDER_PATH, 'file_ids.json')
+
+AUDIO_EXT = '.m4a'
+
+# outputs are locked by a fixed number of locks, so that there's no lock per query to clean up
+OUTPUT_LOCKS = 64
+
 
 class AudioQueueEntry(list):
 
-    def __init__(self, query):
+    def __init__(self, query, model):
         super().__init__(query)
         self.name = default_audio_name(query)
-        self.model = get_model()
+        self.model = model
+        self.missing = set(self.not_available())
 
     def ready(self):
         return all(name in self.model.keys() for name in self)
@@ -28,38 +46,94 @@ class AudioQueueEntry(list):
         return [name for name in self if name not in self.model.keys()]
 
 
+class MissingIndex:
+
+    """Pending audio queue entries indexed by the names they are missing."""
+
+    def __init__(self):
+        self._waiting = defaultdict(list)  # name -> [(queue, entry)]
+
+    def add(self, queue, entry):
+        for name in entry.missing:
+            self._waiting[name].append((queue, entry))
+
+    def arrived(self, name):
+        """Marks the name as available, returns (queue, entry) pairs that aren't missing anything now."""
+        unblocked = []
+        for queue, entry in self._waiting.pop(name, ()):
+            entry.missing.discard(name)
+            if not entry.missing:
+                unblocked.append((queue, entry))
+        return unblocked
+
+
+class FileIdStore:
+
+    """A persistent mapping from concatenation keys to ids of the files Telegram already has."""
+
+    def __init__(self, path=FILE_IDS_PATH):
+        self.path = path
+        self._file_ids = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self._file_ids = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf8') as file_ids_fd:
+                self._file_ids = json.load(file_ids_fd)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w', encoding='utf8') as file_ids_fd:
+            json.dump(self._file_ids, file_ids_fd)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def get(self, key):
+        with self._lock:
+            if self._file_ids is None:
+                self._load()
+            return self._file_ids.get(key)
+
+    def put(self, key, file_id):
+        with self._lock:
+            if self._file_ids is None:
+                self._load()
+            self._file_ids[key] = file_id
+            self._save()
+
+    def discard(self, key):
+        with self._lock:
+            if self._file_ids is None:
+                self._load()
+            if self._file_ids.pop(key, None):
+                self._save()
+
+
 class AudioQueue():
 
     def __init__(self, model, bot, chat_id):
         self.model = model
         self.bot = bot
         self.chat_id = chat_id
-        self.queue = deque()
 
     def add(self, query_entry):
-        entry = AudioQueueEntry(query_entry)
-        if not self._check_and_update_entry(entry):
-            self.queue.append(entry)
-
-    def _check_and_update_entry(self, entry):
-        if entry.ready():
-            self.upload_audio(entry)
-            return True
-        self.notify_not_available(entry)
-        return False
-
-    def update(self):
-        for entry in self.queue:
-            if self._check_and_update_entry(entry):
-                self.queue.remove(entry)
-                self.bot.send_message(
-                    chat_id=self.chat_id,
-                    text=f'The {entry.name} was updated'
-                )
+        entry = AudioQueueEntry(query_entry, self.model)
+        if entry.missing:
             self.notify_not_available(entry)
+            missing_index.add(self, entry)
+        else:
+            self.upload_audio(entry)
+
+    def unblock(self, entry):
+        """Uploads a pending entry whose last missing audio has arrived."""
+        self.bot.send_message(
+            chat_id=self.chat_id,
+            text=f'The {entry.name} was updated'
+        )
+        self.upload_audio(entry)
 
     def notify_not_available(self, entry):
-        names = entry.not_available()
+        names = [name for name in entry if name in entry.missing]
         joined_names_str = '\n'.join(names)
         msg = f'The following audio are missing for {entry.name}:\n{joined_names_str}'
         self.bot.send_message(
@@ -68,49 +142,172 @@ class AudioQueue():
         )
 
     def upload_audio(self, entry):
-        self.model.select(entry)
-        audio_name = default_audio_name(entry)
-        audio_path = f'./res/{audio_name}.m4a'
-        model.concat_audio(audio_path)
         self.bot.send_message(
             chat_id=self.chat_id,
-            text=f'Uploading {audio_name}...'
+            text=f'Queued {entry.name}...'
         )
-        with open(audio_path, 'rb') as audio_fd:
+        get_scheduler().submit(self.chat_id, self._concat_and_upload, entry)
+
+    def _resend_audio(self, key):
+        """Sends the file Telegram already has for the key, returns whether it succeeded."""
+        file_id = file_ids.get(key)
+        if not file_id:
+            return False
+        try:
             self.bot.send_document(
                 chat_id=self.chat_id,
-                document=audio_fd
+                document=file_id
+            )
+        except TelegramError as e:
+            logging.warning(f'B: Couldn\'t resend {file_id}, uploading instead: {e}')
+            file_ids.discard(key)
+            return False
+        return True
+
+    @metrics.timed('bot.concat_and_upload')
+    def _concat_and_upload(self, entry):
+        audio_name = default_audio_name(entry)
+        audio_path = f'./res/{audio_name}{AUDIO_EXT}'
+        key = self.model.concat_key(entry, AUDIO_EXT)
+        if key and self._resend_audio(key):
+            metrics.count('bot.resent')
+            self.bot.send_message(
+                chat_id=self.chat_id,
+                text=f'Done with {audio_name}!'
+            )
+            return
+        self.bot.send_message(
+            chat_id=self.chat_id,
+            text=f'Processing {audio_name}...'
+        )
+        try:
+            # the same query can be processed by two workers at once
+            with output_lock(audio_path):
+                self.model.concat_audio(audio_path, names=entry)
+                with metrics.timer('bot.upload'), open(audio_path, 'rb') as audio_fd:
+                    message = self.bot.send_document(
+                        chat_id=self.chat_id,
+                        document=audio_fd
+                    )
+            if key and message and message.document:
+                file_ids.put(key, message.document.file_id)
+        except ExportError as e:
+            self.bot.send_message(
+                chat_id=self.chat_id,
+                text=str(e)
             )
+            return
+        except Exception:
+            logging.exception(f'B: Couldn\'t make {audio_name}.')
+            self.bot.send_message(
+                chat_id=self.chat_id,
+                text=f'Couldn\'t make {audio_name}, sorry!'
+            )
+            return
+        self.bot.send_message(
+            chat_id=self.chat_id,
+            text=f'Done with {audio_name}!'
+        )
+
+
+class RoundRobinScheduler:
+
+    """Runs jobs on worker threads, taking one job from every chat in turn."""
+
+    def __init__(self, workers=CONCAT_WORKERS):
+        self._jobs = OrderedDict()  # chat_id -> deque of jobs, chats are served front to back
+        self._cond = threading.Condition()
+        self._shutting_down = False
+        self._workers = [
+            threading.Thread(target=self._work, name=f'concat-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, chat_id, func, *args):
+        """Queues a job of the chat."""
+        with self._cond:
+            self._jobs.setdefault(chat_id, deque()).append((func, args, time.perf_counter()))
+            self._cond.notify()
+
+    def _next_job(self):
+        chat_id, jobs = next(iter(self._jobs.items()))
+        job = jobs.popleft()
+        if jobs:
+            # the chat gets its next turn after all the others
+            self._jobs.move_to_end(chat_id)
+        else:
+            del self._jobs[chat_id]
+        return job
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._jobs and not self._shutting_down:
+                    self._cond.wait()
+                if not self._jobs:
+                    return
+                func, args, queued_at = self._next_job()
+            metrics.observe('bot.queue_wait', (time.perf_counter() - queued_at) * 1000)
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('B: A job failed.')
+
+    def shutdown(self):
+        """Finishes the queued jobs and stops the workers."""
+        with self._cond:
+            self._shutting_down = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
 
 
 model = None
-queue = None
+queues = {}
+missing_index = MissingIndex()
+file_ids = FileIdStore()
+scheduler = None
+output_locks = [threading.Lock() for _ in range(OUTPUT_LOCKS)]
+
+
+def output_lock(audio_path):
+    """Returns the lock of the output path, shared with a few other paths."""
+    return output_locks[hash(audio_path) % len(output_locks)]
 
 
 def get_model():
     global model
     if not model:
-        model = RawTextAudioCollection()
-        model.load()
+        # the bot concatenates a lot, so its new entries are kept decoded in the PCM store
+        model = RawTextAudioCollection(lazy=True, pack_audio=True)
     return model
 
 
+def get_scheduler():
+    global scheduler
+    if not scheduler:
+        scheduler = RoundRobinScheduler()
+    return scheduler
+
+
 def get_queue(bot, chat_id):
-    global queue
-    if not queue:
-        queue = AudioQueue(get_model(), bot, chat_id)
-    return queue
+    if chat_id not in queues:
+        queues[chat_id] = AudioQueue(get_model(), bot, chat_id)
+    return queues[chat_id]
 
 
+@metrics.timed('bot.handle_audio_query')
 def handle_audio_query(update, context):
     raw_query = update.message.text
     query = [deniqq(entry_name.strip()) for entry_name in raw_query.split('\n') if entry_name.strip()]
     queue = get_queue(context.bot, update.effective_chat.id)
     queue.add(query)
-    # no need to update because the only query that can be available is the above one
-    # and it's checked and the queue is updated when adding
+    # a query that misses audio is dispatched by add_audio when the last one arrives
 
 
+@metrics.timed('bot.add_audio')
 def add_audio(update, context):
     audio = update.message.audio
     file = context.bot.get_file(audio.file_id)
@@ -122,20 +319,33 @@ def add_audio(update, context):
         )
     else:
         audio_path = f'./res/{audio.title}.flac'
-        converted_audio_path = f'{audio_path[:-5]}.m4a'
         file.download(audio_path)
-        subprocess.run(['ffmpeg', '-y', '-i', audio_path, '-acodec', 'alac', converted_audio_path])
-        os.remove(audio_path)
         model = get_model()
-        model.add(audio.title, converted_audio_path)
+        try:
+            if audio.title in model.keys():
+                # a new recording replaces the audio of the entry
+                model.replace_audio(audio.title, audio_path)
+            else:
+                model.add(audio.title, audio_path)
+        except IngestError as e:
+            context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text=str(e)
+            )
+            return
+        finally:
+            os.remove(audio_path)
         context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=f'Successfully added {audio.title}!'
         )
-        get_queue(context.bot, update.effective_chat.id).update()
+        # the audio can be awaited in any chat
+        for chat_queue, entry in missing_index.arrived(audio.title):
+            chat_queue.unblock(entry)
 
 
 if __name__ == "__main__":
+    metrics.start_from_env()
     updater = Updater(token=TOKEN)
     dispatcher = updater.dispatcher
     audio_query_handler = MessageHandler(Filters.text & (~Filters.command), handle_audio_query)
@@ -145,3 +355,4 @@ if __name__ == "__main__":
     updater.start_polling()
     updater.idle()
     dispatcher.remove_handler(audio_query_handler)
+    get_scheduler().shutdown()
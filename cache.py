@@ -0,0 +1,262 @@
+import os
+import shutil
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from pydub import AudioSegment
+
+
+DECODED_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+RESULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+RESULT_NAMES_EXT = '.names'
+
+
+def file_stamp(path: str) -> Tuple[int, int]:
+    """Returns a (mtime, size) pair that changes whenever the file is rewritten."""
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+class DecodedAudioCache:
+
+    """A bounded LRU cache of decoded audio keyed by file path."""
+
+    def __init__(self, max_bytes=DECODED_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # path -> (stamp, audio)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path: str, decode: Callable[[str], AudioSegment] = AudioSegment.from_file) -> AudioSegment:
+        """Returns decoded audio of the file, decoding it only if it isn't cached or has changed."""
+        key = os.path.abspath(path)
+        stamp = file_stamp(key)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached and cached[0] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        audio = decode(path)
+        self._put(key, stamp, audio)
+        return audio
+
+    def get_many(self, paths: Sequence[str],
+                 decode_many: Callable[[List[str]], List[AudioSegment]]) -> List[AudioSegment]:
+        """Returns decoded audio of the files, decoding all the ones that aren't cached with a single call."""
+        results = [None] * len(paths)
+        missing = OrderedDict()  # path -> (stamp, indices in results)
+        with self._lock:
+            for i, path in enumerate(paths):
+                key = os.path.abspath(path)
+                stamp = file_stamp(key)
+                cached = self._entries.get(key)
+                if cached and cached[0] == stamp:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    results[i] = cached[1]
+                else:
+                    if key not in missing:
+                        self.misses += 1
+                    missing.setdefault(key, (stamp, []))[1].append(i)
+        if missing:
+            for (key, (stamp, indices)), audio in zip(missing.items(), decode_many(list(missing))):
+                self._put(key, stamp, audio)
+                for i in indices:
+                    results[i] = audio
+        return results
+
+    def iter_many(self, paths: Sequence[str],
+                  decode_iter: Callable[[List[str]], Iterator[AudioSegment]]) -> Iterator[AudioSegment]:
+        """Yields decoded audio of the files in order, the ones that aren't cached come from a single
+        call of decode_iter, which can decode them ahead of time.
+        """
+        lookups = []  # (key, stamp, cached audio or None)
+        with self._lock:
+            for path in paths:
+                key = os.path.abspath(path)
+                stamp = file_stamp(key)
+                cached = self._entries.get(key)
+                if cached and cached[0] == stamp:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    lookups.append((key, stamp, cached[1]))
+                else:
+                    self.misses += 1
+                    lookups.append((key, stamp, None))
+        decoded = decode_iter([key for key, _, audio in lookups if audio is None])
+        try:
+            for key, stamp, audio in lookups:
+                if audio is None:
+                    audio = next(decoded)
+                    self._put(key, stamp, audio)
+                yield audio
+        finally:
+            # stops decoding ahead when the caller gives up early
+            decoded.close()
+
+    def _put(self, key, stamp, audio: AudioSegment) -> None:
+        size = len(audio.raw_data)
+        with self._lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                logging.debug(f'M: Not caching {key}, it is larger than the whole cache.')
+                return
+            self._entries[key] = (stamp, audio)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _discard(self, key) -> None:
+        cached = self._entries.pop(key, None)
+        if cached:
+            self._size -= len(cached[1].raw_data)
+
+    def invalidate(self, path: str) -> None:
+        """Drops the decoded audio of the file from the cache."""
+        with self._lock:
+            self._discard(os.path.abspath(path))
+
+    def clear(self) -> None:
+        """Drops everything from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        """Returns the cache counters."""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+decoded_audio_cache = DecodedAudioCache()
+
+
+class ResultCache:
+
+    """A bounded on-disk LRU cache of concatenated audio keyed by content hashes.
+
+    Every result is stored next to a file listing the names of the entries it's made of,
+    so the results can be dropped when any of them changes.
+    """
+
+    def __init__(self, dir, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.dir = dir
+        self.max_bytes = max_bytes
+        self._results = None  # key -> (path, size, names), least recently used first
+        self._keys_by_name = defaultdict(set)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load(self) -> None:
+        """Reads the results kept on the disk, the recently used ones are the recently modified ones."""
+        self._results = OrderedDict()
+        if not os.path.isdir(self.dir):
+            return
+        found = []
+        for file_name in os.listdir(self.dir):
+            key, ext = os.path.splitext(file_name)
+            names_path = os.path.join(self.dir, f'{key}{RESULT_NAMES_EXT}')
+            if ext == RESULT_NAMES_EXT or not os.path.exists(names_path):
+                continue
+            path = os.path.join(self.dir, file_name)
+            with open(names_path, encoding='utf8') as names_fd:
+                names = [line.rstrip('\n') for line in names_fd]
+            st = os.stat(path)
+            found.append((st.st_mtime_ns, key, path, st.st_size, names))
+        for _, key, path, size, names in sorted(found):
+            self._remember(key, path, size, names)
+
+    def _remember(self, key, path, size, names) -> None:
+        self._results[key] = (path, size, names)
+        self._size += size
+        for name in names:
+            self._keys_by_name[name].add(key)
+
+    def _forget(self, key) -> None:
+        path, size, names = self._results.pop(key)
+        self._size -= size
+        for name in names:
+            self._keys_by_name[name].discard(key)
+            if not self._keys_by_name[name]:
+                del self._keys_by_name[name]
+        for stale_path in (path, os.path.join(self.dir, f'{key}{RESULT_NAMES_EXT}')):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the path of the cached result, None if there is no such result."""
+        with self._lock:
+            if self._results is None:
+                self._load()
+            cached = self._results.get(key)
+            if not cached or not os.path.exists(cached[0]):
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            os.utime(cached[0])
+            self.hits += 1
+            return cached[0]
+
+    def put(self, key: str, result_path: str, names: Iterable[str]) -> None:
+        """Stores a copy of the result made of the named entries."""
+        names = list(names)
+        ext = os.path.splitext(result_path)[1]
+        path = os.path.join(self.dir, f'{key}{ext}')
+        with self._lock:
+            if self._results is None:
+                self._load()
+            if key in self._results:
+                self._forget(key)
+            size = os.path.getsize(result_path)
+            if size > self.max_bytes:
+                return
+            os.makedirs(self.dir, exist_ok=True)
+            shutil.copyfile(result_path, f'{path}.tmp')
+            os.replace(f'{path}.tmp', path)
+            with open(os.path.join(self.dir, f'{key}{RESULT_NAMES_EXT}'), 'w', encoding='utf8') as names_fd:
+                names_fd.writelines(f'{name}\n' for name in names)
+            self._remember(key, path, size, names)
+            while self._size > self.max_bytes:
+                self._forget(next(iter(self._results)))
+                self.evictions += 1
+
+    def invalidate(self, names: Iterable[str]) -> None:
+        """Drops every result made with any of the named entries."""
+        with self._lock:
+            if self._results is None:
+                self._load()
+            for name in names:
+                for key in list(self._keys_by_name.get(name, ())):
+                    self._forget(key)
+
+    def stats(self) -> dict:
+        """Returns the cache counters."""
+        with self._lock:
+            return {
+                'entries': len(self._results or ()),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
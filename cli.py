@@ -1,5 +1,11 @@
 import os
+import sys
+import json
+import time
+import argparse
+import threading
 from os import path
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable, Union
 from types import new_class
 from pathlib import Path
@@ -7,7 +13,10 @@ from enum import Enum, auto
 from ctypes import c_uint16 as mutable_int
 from ctypes import c_bool as mutable_bool
 
+import metrics
 from model import RawTextAudioCollection as Model
+from concat import ExportError
+from ingest import IngestError
 from util import basename_without_ext as bwe
 from util import default_audio_name as dan
 from util import wrap_iterable
@@ -16,6 +25,10 @@ from deniqq import deniqq
 
 AUDIO_DIR = 'res'
 
+BATCH_STDIN = '-'
+BATCH_FORMATS = ('auto', 'table', 'jsonl')
+BATCH_WORKERS = os.cpu_count() or 1
+
 LOOP_DIALOG = 'loop_dialog_key'
 CHOICE_MSG = 'choice_msg_key'
 
@@ -152,15 +165,21 @@ def interactive_process_audio_query(model: Model) -> None:
     # model.select(interactive_confirm_names_selected(names))
     model.select(names)
     print('Writing the audio...')
-    model.concat_audio(audio_path)
-    print('Audio was written successfully!')
+    try:
+        model.concat_audio(audio_path)
+        print('Audio was written successfully!')
+    except ExportError as e:
+        print(e)
     model.deselect(names)
 
 def prepare(model) -> None:
     paths_to_add = interactive_get_paths_to_add()
     if paths_to_add:
         names_to_add = list(map(bwe, paths_to_add))
-        model.add(names_to_add, paths_to_add)  # TODO make add async?
+        try:
+            model.add(names_to_add, paths_to_add)  # TODO make add async?
+        except IngestError as e:
+            print(e)
 
 def interactive_process_audio_query_loop(model) -> None:
     interactive_process_audio_query(model)
@@ -173,11 +192,151 @@ def interactive_process_audio_query_loop(model) -> None:
     dialog(dialog_terminated, handlers=handlers)
 
 
+def queries_from_gdrive_table(lines: Iterable[str]) -> Iterable[Iterable[str]]:
+    """Parses queries pasted from the Google Drive table, separated by empty lines.
+
+    Just like in the interactive mode, the first line of every query is the table header.
+    """
+    queries = []
+    names = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip():
+            if names:
+                queries.append(names)
+            names = None
+        elif names is None:
+            names = []  # the header
+        else:
+            names.append(deniqq(line).strip())
+    if names:
+        queries.append(names)
+    return queries
+
+def queries_from_jsonl(lines: Iterable[str]) -> Iterable[dict]:
+    """Parses queries given as JSON lines, either lists of names or {"names": [...], "output": ...} objects."""
+    queries = []
+    for line in lines:
+        if not line.strip():
+            continue
+        query = json.loads(line)
+        if isinstance(query, list):
+            query = {'names': query}
+        query['names'] = [deniqq(name).strip() for name in query['names']]
+        queries.append(query)
+    return queries
+
+def read_batch(batch_path: str, batch_format='auto') -> Iterable[dict]:
+    if batch_path == BATCH_STDIN:
+        lines = sys.stdin.readlines()
+    else:
+        with open(batch_path, encoding='utf8') as batch_fd:
+            lines = batch_fd.readlines()
+    if batch_format == 'auto':
+        first_line = next((line.lstrip() for line in lines if line.strip()), '')
+        batch_format = 'jsonl' if first_line[:1] in ('[', '{') else 'table'
+    if batch_format == 'jsonl':
+        return queries_from_jsonl(lines)
+    return [{'names': names} for names in queries_from_gdrive_table(lines)]
+
+def batch_output_path(model: Model, query: dict, output_dir: str, skip_missing: bool) -> str:
+    names = query['names']
+    if skip_missing:
+        names = [name for name in names if name in model]
+    return query.get('output') or os.path.join(output_dir, f'{dan(names)}.m4a')
+
+def batch_process_audio_query(model: Model, query: dict, output_dir: str, skip_missing: bool) -> dict:
+    names = query['names']
+    missing = [name for name in names if name not in model]
+    if skip_missing:
+        names = [name for name in names if name in model]
+    audio_path = batch_output_path(model, query, output_dir, skip_missing)
+    result = {'names': query['names'], 'output': audio_path, 'missing': missing}
+    start = time.perf_counter()
+    if missing and not skip_missing:
+        result['status'] = 'missing'
+    elif len(names) < 2:
+        result['status'] = 'too_short'
+    else:
+        try:
+            model.concat_audio(audio_path, names=names)
+            result['status'] = 'ok'
+        except Exception as e:
+            # a nightly job shouldn't stop because of a single broken query
+            result['status'] = 'failed'
+            result['error'] = str(e)
+    result['secs'] = round(time.perf_counter() - start, 3)
+    return result
+
+def batch_process_audio_queries(model: Model, queries: Iterable[dict], output_dir=AUDIO_DIR,
+                                skip_missing=False, workers=BATCH_WORKERS) -> dict:
+    """Concatenates audio for every query with a pool of workers, returns the summary."""
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    queries = list(queries)
+    # queries with the same output mustn't write it at once, or remove it on each other's failure
+    output_locks = {
+        batch_output_path(model, query, output_dir, skip_missing): threading.Lock() for query in queries
+    }
+
+    def process(query):
+        with output_locks[batch_output_path(model, query, output_dir, skip_missing)]:
+            return batch_process_audio_query(model, query, output_dir, skip_missing)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(process, queries))
+    statuses = [result['status'] for result in results]
+    return {
+        'queries': results,
+        'total': len(results),
+        'ok': statuses.count('ok'),
+        'missing': statuses.count('missing'),
+        'failed': len(statuses) - statuses.count('ok') - statuses.count('missing'),
+        'secs': round(time.perf_counter() - start, 3),
+    }
+
+def batch(args) -> int:
+    model = Model(lazy=True)
+    summary = batch_process_audio_queries(
+        model,
+        read_batch(args.batch, args.format),
+        output_dir=args.output_dir,
+        skip_missing=args.skip_missing,
+        workers=args.workers,
+    )
+    summary_json = json.dumps(summary, ensure_ascii=False, indent=2)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf8') as summary_fd:
+            summary_fd.write(summary_json)
+    else:
+        print(summary_json)
+    return 0 if summary['ok'] == summary['total'] else 1
+
+
 def mainloop() -> None:
-    model = Model()  # TODO make load async
+    model = Model(lazy=True)
     prepare(model)
     interactive_process_audio_query_loop(model)
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Concatenates audio entries interactively or in a batch.')
+    parser.add_argument('--batch', metavar='FILE',
+                        help=f'process the queries from the file ({BATCH_STDIN} for stdin) without asking anything')
+    parser.add_argument('--format', choices=BATCH_FORMATS, default='auto',
+                        help='format of the batch: pasted Google Drive table queries separated by empty lines, '
+                             'or JSON lines')
+    parser.add_argument('--output-dir', default=AUDIO_DIR, help='where the concatenated audio is written')
+    parser.add_argument('--summary', metavar='FILE', help='where the JSON summary is written, stdout by default')
+    parser.add_argument('--skip-missing', action='store_true',
+                        help='concatenate the entries that exist instead of skipping queries with missing ones')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='number of concatenations run at once')
+    return parser.parse_args(argv)
+
+
 if __name__ == '__main__':
+    metrics.start_from_env()
+    args = parse_args()
+    if args.batch:
+        sys.exit(batch(args))
     mainloop()
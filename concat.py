@@ -0,0 +1,434 @@
+import os
+import logging
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from collections import deque
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.utils import mediainfo_json
+
+from cache import file_stamp
+from pcmstore import PcmSlice, SAMPLE_TYPES
+
+
+# raw formats of pydub's (signed) PCM by sample width
+RAW_FORMATS = {1: 's8', 2: 's16le', 4: 's32le'}
+
+WAV_CODECS = {1: 'pcm_u8', 2: 'pcm_s16le', 4: 'pcm_s32le'}
+
+# m4a is ALAC, the same codec audio entries are stored with
+EXPORT_CODECS = {
+    '.m4a': 'alac',
+    '.flac': 'flac',
+    '.mp3': 'libmp3lame',
+    '.ogg': 'libvorbis',
+    '.opus': 'libopus',
+}
+
+CHANNEL_LAYOUTS = {1: 'mono', 2: 'stereo'}
+
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+# how often a running ffmpeg checks whether it's cancelled
+CANCEL_POLL_SECS = 0.1
+
+
+class ExportError(Exception):
+    def __init__(self, output_path, details=None):
+        msg = f'Couldn\'t export audio to {output_path}'
+        if details:
+            msg += f': {details}'
+        super().__init__(msg)
+
+
+class ConcatCancelled(Exception):
+    def __init__(self, output_path=None):
+        msg = 'Concatenation was cancelled'
+        if output_path:
+            msg += f': {output_path}'
+        super().__init__(msg)
+
+
+_worker_pools = {}  # number of workers -> pool
+_worker_pools_lock = threading.Lock()
+
+
+def worker_pool(workers: int) -> ProcessPoolExecutor:
+    """Returns a shared pool of worker processes for decoding and ingesting audio."""
+    with _worker_pools_lock:
+        if workers not in _worker_pools:
+            # forking a process that runs threads (like the bot) isn't safe
+            _worker_pools[workers] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _worker_pools[workers]
+
+
+def _decode_to_shared_memory(audio_path: str) -> Tuple[str, int, int, int, int]:
+    """Decodes the file into a new shared memory block owned by the caller."""
+    audio = AudioSegment.from_file(audio_path)
+    data = audio.raw_data
+    shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[:len(data)] = data
+    # the block outlives this process, it's unlinked by the process that reads it
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+    return shm.name, len(data), audio.channels, audio.frame_rate, audio.sample_width
+
+
+def _read_shared_memory(name: str, size: int, channels: int, frame_rate: int, sample_width: int) -> AudioSegment:
+    """Copies decoded audio out of a shared memory block and frees the block."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+    return AudioSegment(
+        data=data,
+        sample_width=sample_width,
+        frame_rate=frame_rate,
+        channels=channels
+    )
+
+
+def decode_parallel(audio_paths: Sequence[str], workers: int) -> List[AudioSegment]:
+    """Decodes the files with a pool of worker processes, keeping their order."""
+    return [
+        _read_shared_memory(*decoded)
+        for decoded in worker_pool(workers).map(_decode_to_shared_memory, audio_paths)
+    ]
+
+
+def decode_ahead(audio_paths: Iterable[str], workers: int) -> Iterator[AudioSegment]:
+    """Decodes the files with a pool of worker processes, at most that many files ahead of the consumer."""
+    pool = worker_pool(workers)
+    pending = deque()
+    try:
+        for audio_path in audio_paths:
+            pending.append(pool.submit(_decode_to_shared_memory, audio_path))
+            if len(pending) >= workers:
+                yield _read_shared_memory(*pending.popleft().result())
+        while pending:
+            yield _read_shared_memory(*pending.popleft().result())
+    finally:
+        # free the blocks decoded for a consumer that stopped early
+        for future in pending:
+            if not future.cancel() and not future.exception():
+                _read_shared_memory(*future.result())
+
+
+def _conform(audio: AudioSegment, channels: int, frame_rate: int, sample_width: int) -> AudioSegment:
+    """Converts audio to the given parameters in the same order pydub syncs segments."""
+    return audio.set_channels(channels).set_frame_rate(frame_rate).set_sample_width(sample_width)
+
+
+@lru_cache(maxsize=32)
+def _pause_size(pause_ms: int, channels: int, frame_rate: int, sample_width: int) -> int:
+    """Returns the size in bytes of a pause converted to the given parameters."""
+    return len(_conform(AudioSegment.silent(pause_ms), channels, frame_rate, sample_width).raw_data)
+
+
+def merge_params(params: Iterable[Tuple[int, int, int]]) -> Tuple[int, int, int]:
+    """Returns the (channels, frame_rate, sample_width) audio with the given parameters is converted to."""
+    # the pause takes part in the choice, just like it does when appending segments with pydub
+    pause = AudioSegment.silent(0)
+    params = (*params, (pause.channels, pause.frame_rate, pause.sample_width))
+    return tuple(max(param) for param in zip(*params))
+
+
+def target_params(segments: Sequence[AudioSegment]) -> Tuple[int, int, int]:
+    """Returns the (channels, frame_rate, sample_width) every segment is converted to."""
+    return merge_params((seg.channels, seg.frame_rate, seg.sample_width) for seg in segments)
+
+
+def _as_audio_segment(segment: Union[AudioSegment, PcmSlice]) -> AudioSegment:
+    return segment.to_audio_segment() if isinstance(segment, PcmSlice) else segment
+
+
+def shape_segment(segment: Union[AudioSegment, PcmSlice], trim_ms: Optional[Sequence[int]] = None,
+                  gain_db: float = 0.0) -> Union[AudioSegment, PcmSlice]:
+    """Trims the segment to (start, end) milliseconds and applies the gain.
+
+    Trimming a slice of the PCM store doesn't copy anything.
+    """
+    frame_width = segment.channels * segment.sample_width
+    data = segment.raw_data
+    if trim_ms:
+        start, end = (ms * segment.frame_rate // 1000 * frame_width for ms in trim_ms)
+        data = memoryview(data)[start:end]
+    if gain_db:
+        sample_type = SAMPLE_TYPES[segment.sample_width]
+        limits = np.iinfo(sample_type)
+        samples = np.frombuffer(data, dtype=sample_type) * (10 ** (gain_db / 20))
+        data = np.clip(np.rint(samples), limits.min, limits.max).astype(sample_type).tobytes()
+    if data is segment.raw_data:
+        return segment
+    if isinstance(segment, PcmSlice):
+        return segment._replace(raw_data=memoryview(data))
+    return segment._spawn(bytes(data))
+
+
+def concat_segments(segments: Sequence[Union[AudioSegment, PcmSlice]], pause_ms: int) -> AudioSegment:
+    """Concatenates segments with pauses between them into a single preallocated buffer."""
+    params = target_params(segments)
+    if len({(seg.channels, seg.frame_rate, seg.sample_width) for seg in segments}) > 1:
+        logging.warning(f'M: Audio samples have different parameters, converting them to '
+                        f'{params[0]} channel(s), {params[1]} Hz, {params[2] * 8} bit.')
+    converted = [
+        seg if (seg.channels, seg.frame_rate, seg.sample_width) == params
+        else _conform(_as_audio_segment(seg), *params)
+        for seg in segments
+    ]
+    pause_size = _pause_size(pause_ms, *params)
+    total = sum(len(seg.raw_data) for seg in converted) + pause_size * (len(converted) - 1)
+    result = np.empty(total, dtype=np.uint8)
+    pos = 0
+    for i, seg in enumerate(converted):
+        if i:
+            result[pos:pos + pause_size] = 0
+            pos += pause_size
+        data = np.frombuffer(seg.raw_data, dtype=np.uint8)
+        result[pos:pos + len(data)] = data
+        pos += len(data)
+    channels, frame_rate, sample_width = params
+    return AudioSegment(
+        data=result.tobytes(),
+        sample_width=sample_width,
+        frame_rate=frame_rate,
+        channels=channels
+    )
+
+
+def concat_pcm_size(durations_ms: Sequence[int], params: Tuple[int, int, int], pause_ms: int) -> int:
+    """Estimates the size of the PCM iter_concat_pcm() yields for segments of the given durations."""
+    channels, frame_rate, sample_width = params
+    frames = sum(duration_ms * frame_rate // 1000 for duration_ms in durations_ms)
+    pauses = max(len(durations_ms) - 1, 0) * _pause_size(pause_ms, *params)
+    return frames * channels * sample_width + pauses
+
+
+def iter_concat_pcm(segments: Iterable[Union[AudioSegment, PcmSlice]], params: Tuple[int, int, int],
+                    pause_ms: int) -> Iterator[bytes]:
+    """Yields PCM of the segments with pauses between them, converted to the given parameters.
+
+    Segments are consumed one by one, so only one of them has to be in memory at a time.
+    The output is the same as concat_segments() gives for the same parameters.
+    """
+    pause = bytes(_pause_size(pause_ms, *params))
+    for i, seg in enumerate(segments):
+        if i:
+            yield pause
+        if (seg.channels, seg.frame_rate, seg.sample_width) != params:
+            logging.debug(f'M: Converting a segment to {params[0]} channel(s), '
+                          f'{params[1]} Hz, {params[2] * 8} bit.')
+            seg = _conform(_as_audio_segment(seg), *params)
+        yield seg.raw_data
+
+
+def codec_args(output_path: str, sample_width: int) -> List[str]:
+    """Returns ffmpeg arguments that choose the codec for the output path extension."""
+    ext = os.path.splitext(output_path)[1].lower()
+    if ext == '.wav':
+        return ['-c:a', WAV_CODECS[sample_width]]
+    if ext in EXPORT_CODECS:
+        return ['-c:a', EXPORT_CODECS[ext]]
+    # let ffmpeg pick the default codec of the container
+    return []
+
+
+def export_audio(audio: AudioSegment, output_path: str, progress=None, cancel=None) -> None:
+    """Encodes audio to the output path by piping its PCM into ffmpeg."""
+    data = memoryview(audio.raw_data)
+    chunks = (data[i:i + EXPORT_CHUNK_SIZE] for i in range(0, len(data), EXPORT_CHUNK_SIZE))
+    export_pcm_stream(
+        chunks, (audio.channels, audio.frame_rate, audio.sample_width), output_path,
+        progress=progress, cancel=cancel, total=len(data)
+    )
+
+
+def check_cancelled(cancel: Optional[threading.Event], output_path=None) -> None:
+    if cancel and cancel.is_set():
+        raise ConcatCancelled(output_path)
+
+
+def export_pcm_stream(chunks: Iterable[bytes], params: Tuple[int, int, int], output_path: str,
+                      progress=None, cancel=None, total=0) -> None:
+    """Encodes PCM to the output path while it is being produced, by writing it into ffmpeg's stdin.
+
+    With the total size of the PCM known or estimated, progress is called with ('encode', bytes written, total).
+    Setting the cancel event kills ffmpeg and removes the partial output.
+    """
+    channels, frame_rate, sample_width = params
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', RAW_FORMATS[sample_width],
+        '-ar', str(frame_rate),
+        '-ac', str(channels),
+        '-i', 'pipe:0',
+        *codec_args(output_path, sample_width),
+        output_path
+    ]
+    # stderr goes to a file, a pipe nobody reads while writing stdin could fill up and block ffmpeg
+    with tempfile.TemporaryFile() as stderr_fd:
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=stderr_fd)
+        except OSError as e:
+            raise ExportError(output_path, str(e)) from e
+        try:
+            written = 0
+            try:
+                for chunk in chunks:
+                    check_cancelled(cancel, output_path)
+                    proc.stdin.write(chunk)
+                    written += len(chunk)
+                    if progress and total:
+                        # the total can be an estimate
+                        progress('encode', min(written, total), total)
+                check_cancelled(cancel, output_path)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass  # ffmpeg has failed, its error is reported below
+            while True:
+                try:
+                    returncode = proc.wait(timeout=CANCEL_POLL_SECS if cancel else None)
+                    break
+                except subprocess.TimeoutExpired:
+                    check_cancelled(cancel, output_path)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+        stderr_fd.seek(0)
+        details = stderr_fd.read().decode('utf8', errors='replace').strip()
+    if returncode != 0:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise ExportError(output_path, details)
+
+
+_probe_cache = {}  # path -> (stamp, stream params)
+_probe_lock = threading.Lock()
+
+
+def probe_stream(audio_path: str) -> Optional[Tuple]:
+    """Returns the codec parameters of the first audio stream of the file, None if unknown."""
+    key = os.path.abspath(audio_path)
+    try:
+        stamp = file_stamp(key)
+    except OSError:
+        return None
+    with _probe_lock:
+        cached = _probe_cache.get(key)
+        if cached and cached[0] == stamp:
+            return cached[1]
+    try:
+        info = mediainfo_json(key)
+    except (OSError, ValueError) as e:
+        logging.debug(f'M: Couldn\'t probe {audio_path}: {e}')
+        return None
+    streams = [s for s in info.get('streams', []) if s.get('codec_type') == 'audio']
+    if not streams:
+        return None
+    stream = streams[0]
+    params = (
+        stream.get('codec_name'),
+        int(stream.get('sample_rate', 0)),
+        int(stream.get('channels', 0)),
+        stream.get('sample_fmt'),
+        int(stream.get('bits_per_raw_sample') or 0),
+    )
+    with _probe_lock:
+        _probe_cache[key] = (stamp, params)
+    return params
+
+
+def pause_clip(params: Tuple, pause_ms: int, cache_dir: str) -> Optional[str]:
+    """Returns the path to a silent clip encoded with the given codec parameters, None if it can't be made."""
+    codec, frame_rate, channels, sample_fmt, bits = params
+    if channels not in CHANNEL_LAYOUTS:
+        return None
+    ext = next((ext for ext, ext_codec in EXPORT_CODECS.items() if ext_codec == codec), None)
+    if not ext:
+        return None
+    path = os.path.join(cache_dir, f'pause-{pause_ms}ms-{codec}-{frame_rate}-{channels}-{sample_fmt}-{bits}{ext}')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # several concatenations can make the same clip at once
+        tmp_fd, tmp_path = tempfile.mkstemp(suffix=ext, dir=cache_dir)
+        os.close(tmp_fd)
+        proc = subprocess.run([
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'lavfi',
+            '-i', f'anullsrc=r={frame_rate}:cl={CHANNEL_LAYOUTS[channels]}',
+            '-t', str(pause_ms / 1000),
+            '-c:a', codec,
+            '-sample_fmt', sample_fmt,
+            tmp_path
+        ], capture_output=True)
+        if proc.returncode != 0:
+            logging.debug(f'M: Couldn\'t make a pause clip: {proc.stderr.decode("utf8", errors="replace")}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, path)
+    if probe_stream(path) != params:
+        return None
+    return path
+
+
+def _concat_list_line(path: str) -> str:
+    escaped = os.path.abspath(path).replace("'", "'\\''")
+    return f"file '{escaped}'\n"
+
+
+def stream_copy_concat(audio_paths: Sequence[str], pause_ms: int, output_path: str, cache_dir: str) -> bool:
+    """Concatenates the files with pauses between them without re-encoding.
+
+    Only works when all the files share the codec parameters and the codec is the one
+    the output path extension is exported with. Returns whether the output was written.
+    """
+    params = {probe_stream(path) for path in audio_paths}
+    if len(params) != 1 or None in params:
+        return False
+    params = params.pop()
+    ext = os.path.splitext(output_path)[1].lower()
+    if EXPORT_CODECS.get(ext) != params[0]:
+        return False
+    pause_path = pause_clip(params, pause_ms, cache_dir)
+    if not pause_path:
+        return False
+    list_fd, list_path = tempfile.mkstemp(suffix='.txt', text=True)
+    try:
+        with os.fdopen(list_fd, 'w', encoding='utf8') as list_file:
+            for i, path in enumerate(audio_paths):
+                if i:
+                    list_file.write(_concat_list_line(pause_path))
+                list_file.write(_concat_list_line(path))
+        proc = subprocess.run([
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0',
+            '-i', list_path,
+            '-map', '0:a', '-c', 'copy',
+            output_path
+        ], capture_output=True)
+    finally:
+        os.remove(list_path)
+    if proc.returncode != 0:
+        logging.warning(f'M: Stream copy concatenation failed, falling back to decoding: '
+                        f'{proc.stderr.decode("utf8", errors="replace").strip()}')
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return False
+    return True
@@ -1,29 +1,125 @@
 import tkinter as tk
 from tkinter import messagebox, filedialog
+import os
 import logging
+import queue
+import threading
 
 
+import metrics
 from view import *
 from model import RawTextAudioCollection
+from concat import ConcatCancelled
+from ingest import IngestError
 from util import *
 
 
+# how often the main thread picks up the events of the concatenation jobs
+CONCAT_POLL_MS = 100
+
+CONCAT_STAGE_TEXTS = {'decode': 'Decoded', 'encode': 'encoded'}
+
+
+class ConcatJobs:
+
+    """Concatenates audio on a worker thread, one queued job after another.
+
+    The worker never touches Tk: it posts (event, output path, *details) tuples to the events
+    queue, and the main thread picks them up with poll().
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.events = queue.Queue()
+        self._jobs = queue.Queue()
+        self._cancel = threading.Event()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='concat', daemon=True)
+        self._thread.start()
+
+    def submit(self, output_path, names):
+        with self._lock:
+            self._pending += 1
+        self._jobs.put((output_path, list(names)))
+
+    def pending(self) -> int:
+        """Returns the number of the jobs that are queued or running."""
+        with self._lock:
+            return self._pending
+
+    def cancel(self):
+        """Cancels the running job, the queued ones still run."""
+        self._cancel.set()
+
+    def poll(self):
+        """Returns the events posted since the previous poll."""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def _run(self):
+        while True:
+            output_path, names = self._jobs.get()
+            self._cancel.clear()
+            self.events.put(('started', output_path))
+            try:
+                self.model.concat_audio(
+                    output_path, names,
+                    progress=lambda stage, done, total: self.events.put(('progress', output_path, stage, done, total)),
+                    cancel=self._cancel
+                )
+                event = ('done', output_path)
+            except ConcatCancelled:
+                event = ('cancelled', output_path)
+            except Exception as e:
+                logging.exception(f'C: Concatenation into {output_path} failed.')
+                event = ('failed', output_path, str(e))
+            with self._lock:
+                self._pending -= 1
+            self.events.put(event)
+
+
 class Controller:
 
     def __init__(self, root):
-        self.model = RawTextAudioCollection()
+        self.root = root
+        self.model = RawTextAudioCollection(lazy=True)
         self.view = MainView(root)
+        self.concat_jobs = ConcatJobs(self.model)
         self.model.add_callback(self.model_changed)
         self.view.display(self.model)
         self.view.add_button.config(command=self.dialog_add_entry)
         self.view.remove_button.config(command=self.dialog_remove_entry)
         self.view.rename_button.config(command=self.dialog_rename_entry)
         self.view.concat_button.config(command=self.dialog_concat_audio)
+        self.view.cancel_button.config(command=self.concat_jobs.cancel)
         self.view.entries_listbox.bind('<<ListboxSelect>>', lambda e: self._listbox_select_handler())
+        self.view.filter_text_var.trace_add('write', lambda *args: self._filter_changed())
         self.current_dialog = None
+        self._concat_progress = {}  # stage -> percent of the running merge
+        self.root.after(CONCAT_POLL_MS, self._poll_concat_jobs)
+
+    def model_changed(self, changes):
+        logging.debug(f'C: Model changed: {changes}')
+        if changes.reloaded:
+            self.view.display(self.model)
+            self.view.select_names(self.model.names_selected())
+        else:
+            self.view.apply_changes(changes)
+            # renamed entries stay selected
+            selection = set(self.model.names_selected())
+            self.view.select_names(name for name in changes.renamed.values() if name in selection)
+        self.view.listbox_select_handler()
 
-    def model_changed(self):
-        self.view.display(self.model)
+    def _filter_changed(self):
+        self.view.set_filter(self.view.filter_text_var.get())
+        # entries hidden by the filter stay selected in the model
+        self.view.select_names(self.model.names_selected())
+        self.view.listbox_select_handler()
 
     def _dispose_current_dialog(self):
         if not self.current_dialog:
@@ -38,7 +134,11 @@ class Controller:
 
     def add_entry(self):
         # TODO validate
-        self.model.add(self.current_dialog.name_entry.get(), self.current_dialog.path_entry.get())
+        try:
+            self.model.add(self.current_dialog.name_entry.get(), self.current_dialog.path_entry.get())
+        except IngestError as e:
+            messagebox.showerror(title=ADD_TITLE, message=str(e))
+            return
         self._dispose_current_dialog()
 
     def dialog_remove_entry(self):
@@ -78,25 +178,55 @@ class Controller:
             initialfile=default_audio_name(self.model.names_selected())
         )
         if filepath:
-            self.model.concat_audio(filepath)
+            # the selection can change while the job waits in the queue
+            self.concat_jobs.submit(filepath, self.model.names_selected())
+            self.view.show_concat_status(f'Queued {os.path.basename(filepath)}', pending=self.concat_jobs.pending())
+
+    def _poll_concat_jobs(self):
+        for event, output_path, *details in self.concat_jobs.poll():
+            name = os.path.basename(output_path)
+            pending = self.concat_jobs.pending()
+            if event == 'started':
+                self._concat_progress = {}
+                self.view.show_concat_status(f'Merging {name}...', 0, busy=True, pending=pending)
+            elif event == 'progress':
+                # streaming decodes and encodes at once, the encoding tells how far the whole merge is
+                stage, done, total = details
+                self._concat_progress[stage] = 100 * done / total if total else 0
+                text = ', '.join(
+                    f'{CONCAT_STAGE_TEXTS[stage]} {percent:.0f}%' for stage, percent in self._concat_progress.items()
+                )
+                percent = self._concat_progress.get('encode', self._concat_progress.get('decode'))
+                self.view.show_concat_status(text, percent, busy=True, pending=pending)
+            elif event == 'done':
+                self.view.show_concat_status(f'Merged {name}', 100, pending=pending)
+            elif event == 'cancelled':
+                self.view.show_concat_status(f'Cancelled {name}', pending=pending)
+            elif event == 'failed':
+                self.view.show_concat_status(f'Failed {name}', pending=pending)
+                messagebox.showerror(title=CONCAT_TITLE, message=details[0])
+        self.root.after(CONCAT_POLL_MS, self._poll_concat_jobs)
 
     def _listbox_select_handler(self):
         view_selection = self.view.selection()
         logging.debug(f'C: View selection before listbox handler: {view_selection}')
-        model_selection = list(self.model.names_selected())
+        model_selection = set(self.model.names_selected())
         logging.debug(f'C: Model selection before listbox handler: {model_selection}')
-        for view_entry in view_selection:
-            if view_entry not in model_selection:
-                self.model.select((view_entry, ))
-        for model_entry in model_selection:
-            if model_entry not in view_selection:
-                self.model.deselect((model_entry, ))
+        view_selection_set = set(view_selection)
+        # keep the order of the listbox for the newly selected entries
+        self.model.select([name for name in view_selection if name not in model_selection])
+        # entries hidden by the filter can't be deselected in the listbox
+        self.model.deselect([
+            name for name in model_selection
+            if name not in view_selection_set and self.view.is_shown(name)
+        ])
         logging.debug(f'C: View selection after listbox handler: {list(self.view.selection())}')
         logging.debug(f'C: Model selection after listbox handler: {list(self.model.names_selected())}')
         self.view.listbox_select_handler()
 
 
 if __name__ == '__main__':
+    metrics.start_from_env()
     root = tk.Tk()
     root.withdraw()
     app = Controller(root)
@@ -0,0 +1,193 @@
+import os
+import hashlib
+import subprocess
+
+from typing import Optional
+
+import numpy as np
+from pydub import AudioSegment
+
+import metrics
+from concat import probe_stream
+from pcmstore import PcmStore, SAMPLE_TYPES
+
+
+CANONICAL_FRAME_RATE = 44100
+CANONICAL_CHANNELS = 1
+CANONICAL_SAMPLE_WIDTH = 2
+CANONICAL_CODEC = 'alac'
+CANONICAL_EXT = '.m4a'
+
+# audio files with these extensions can become entries, ffmpeg reads them all
+AUDIO_EXTS = {
+    '.m4a', '.mp3', '.flac', '.wav', '.ogg', '.oga', '.opus', '.aac',
+    '.wma', '.aif', '.aiff', '.amr', '.3gp', '.webm', '.mka',
+}
+
+# metadata keys of the file an entry was ingested from
+SOURCE_KEY = 'source'
+SOURCE_HASH_KEY = 'source_hash'
+
+# metadata key of the entry's PCM in the PCM store
+PCM_KEY = 'pcm_key'
+
+# metadata key of the hash of the entry's canonical PCM
+CONTENT_HASH_KEY = 'content_hash'
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# metadata keys of the precomputed shaping of an entry
+TRIM_KEY = 'trim_ms'
+GAIN_KEY = 'gain_db'
+# the untrimmed length, tells whether the trim cuts anything
+DURATION_KEY = 'duration_ms'
+
+ANALYSIS_WINDOW_MS = 10
+# windows quieter than this (relative to the full scale) are silence
+SILENCE_THRESHOLD_DBFS = -50.0
+# silence kept around the speech so that it isn't cut too close
+TRIM_PADDING_MS = 50
+TARGET_RMS_DBFS = -20.0
+MAX_PEAK_DBFS = -1.0
+
+# ALAC sample formats by sample width
+SAMPLE_FORMATS = {2: 's16p', 4: 's32p'}
+
+CANONICAL_STREAM = (
+    CANONICAL_CODEC,
+    CANONICAL_FRAME_RATE,
+    CANONICAL_CHANNELS,
+    SAMPLE_FORMATS[CANONICAL_SAMPLE_WIDTH],
+    CANONICAL_SAMPLE_WIDTH * 8,
+)
+
+
+class IngestError(Exception):
+    def __init__(self, audio_path, details=None):
+        msg = f'Couldn\'t ingest {audio_path}'
+        if details:
+            msg += f': {details}'
+        super().__init__(msg)
+
+
+def canonical_params() -> dict:
+    """Returns the PCM parameters every ingested audio is converted to."""
+    return {
+        'frame_rate': CANONICAL_FRAME_RATE,
+        'channels': CANONICAL_CHANNELS,
+        'sample_width': CANONICAL_SAMPLE_WIDTH,
+    }
+
+
+def is_canonical(audio_path: str) -> bool:
+    return probe_stream(audio_path) == CANONICAL_STREAM
+
+
+def normalize_audio(audio_path: str, output_path: str) -> dict:
+    """Converts audio to the canonical format, returns its parameters.
+
+    The output can be the same file as the input, it's replaced only when the conversion succeeds.
+    """
+    if os.path.abspath(audio_path) == os.path.abspath(output_path) and is_canonical(audio_path):
+        return canonical_params()
+    tmp_path = f'{output_path}.tmp{CANONICAL_EXT}'
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-i', audio_path,
+        '-vn',
+        '-ar', str(CANONICAL_FRAME_RATE),
+        '-ac', str(CANONICAL_CHANNELS),
+        '-sample_fmt', SAMPLE_FORMATS[CANONICAL_SAMPLE_WIDTH],
+        '-c:a', CANONICAL_CODEC,
+        tmp_path
+    ]
+    try:
+        proc = subprocess.run(cmd, capture_output=True)
+    except OSError as e:
+        raise IngestError(audio_path, str(e)) from e
+    if proc.returncode != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise IngestError(audio_path, proc.stderr.decode('utf8', errors='replace').strip())
+    os.replace(tmp_path, output_path)
+    return canonical_params()
+
+
+def _dbfs(value: float, full_scale: float) -> float:
+    return 20 * np.log10(max(value, 1e-12) / full_scale)
+
+
+def analyze_audio(audio: AudioSegment) -> dict:
+    """Computes the trim offsets and the normalization gain of the audio.
+
+    Returns the metadata to store in the entry: the (start, end) of the non-silent part
+    in milliseconds, the gain in dB that brings its loudness to the target and the duration.
+    """
+    samples = np.frombuffer(audio.raw_data, dtype=SAMPLE_TYPES[audio.sample_width])
+    full_scale = float(1 << (8 * audio.sample_width - 1))
+    # the loudest channel of every frame
+    frames = np.abs(samples.reshape(-1, audio.channels).astype(np.float64)).max(axis=1)
+    window = max(audio.frame_rate * ANALYSIS_WINDOW_MS // 1000, 1)
+    windows = len(frames) // window
+    if not windows:
+        return {TRIM_KEY: [0, len(audio)], GAIN_KEY: 0.0, DURATION_KEY: len(audio)}
+    rms = np.sqrt(np.mean(np.square(frames[:windows * window].reshape(windows, window)), axis=1))
+    threshold = full_scale * 10 ** (SILENCE_THRESHOLD_DBFS / 20)
+    loud = np.flatnonzero(rms > threshold)
+    if not len(loud):
+        # nothing but silence, leave it as it is
+        return {TRIM_KEY: [0, len(audio)], GAIN_KEY: 0.0, DURATION_KEY: len(audio)}
+    start_ms = max(int(loud[0]) * ANALYSIS_WINDOW_MS - TRIM_PADDING_MS, 0)
+    end_ms = min((int(loud[-1]) + 1) * ANALYSIS_WINDOW_MS + TRIM_PADDING_MS, len(audio))
+    speech = rms[loud]
+    gain = TARGET_RMS_DBFS - _dbfs(float(np.sqrt(np.mean(np.square(speech)))), full_scale)
+    # don't let the gain clip the peaks
+    gain = min(gain, MAX_PEAK_DBFS - _dbfs(float(frames.max()), full_scale))
+    return {TRIM_KEY: [start_ms, end_ms], GAIN_KEY: round(float(gain), 2), DURATION_KEY: len(audio)}
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_hash(audio: AudioSegment) -> str:
+    """Hashes the PCM of the audio together with its parameters."""
+    digest = hashlib.sha256(f'{audio.channels}:{audio.frame_rate}:{audio.sample_width}:'.encode('utf8'))
+    digest.update(audio.raw_data)
+    return digest.hexdigest()
+
+
+def ingest_file(name: str, audio_path: str, dir: str, known_hash=None, pcm_store_path=None) -> Optional[tuple]:
+    """Converts an audio file to a canonical entry audio in dir and analyzes it.
+
+    Returns the (name, converted audio path, metadata) of the entry, None if the file's
+    hash is the known one, i.e. it didn't change since it was ingested. With a PCM store path,
+    the PCM is packed into that store under its content hash, once for all the copies.
+    Runs in worker processes, so it only takes picklable arguments; the stages it times
+    there are recorded by the metrics of the worker, not of the caller.
+    """
+    if known_hash and file_hash(audio_path) == known_hash:
+        return None
+    converted_audio_path = os.path.join(dir, f'{name}{CANONICAL_EXT}')
+    with metrics.timer('ingest.convert'):
+        meta = normalize_audio(audio_path, converted_audio_path)
+    with metrics.timer('ingest.decode'):
+        audio = AudioSegment.from_file(converted_audio_path)
+    with metrics.timer('ingest.analyze'):
+        meta.update(analyze_audio(audio))
+    with metrics.timer('ingest.hash'):
+        # the source is hashed after the conversion, which could have been made in place
+        meta[SOURCE_KEY] = os.path.basename(audio_path)
+        meta[SOURCE_HASH_KEY] = file_hash(audio_path)
+        meta[CONTENT_HASH_KEY] = content_hash(audio)
+    if pcm_store_path:
+        meta[PCM_KEY] = meta[CONTENT_HASH_KEY]
+        pcm_store = PcmStore(pcm_store_path)
+        if meta[PCM_KEY] not in pcm_store:
+            with metrics.timer('ingest.pack'):
+                pcm_store.put(meta[PCM_KEY], audio)
+    return name, converted_audio_path, meta
@@ -0,0 +1,122 @@
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from pcmstore import FileLock, LOCK_EXT
+
+
+COMMIT_MARKER = {'commit': True}
+
+
+class FileJournal:
+
+    """Writes and deletes small files, either right away or as a group committed through a journal.
+
+    A group is first written to the journal file and synced once, then applied file by file
+    with atomic replaces. The journal is removed after a single sync of the directories it
+    touched; one left by a crash is applied again by recover(), or dropped if it was never
+    completely written. Processes sharing the journal commit and recover one at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f'{path}{LOCK_EXT}'
+        self._ops = None  # path -> content, None deletes the file
+        self._depth = 0
+        self._lock = threading.RLock()
+
+    def begin(self) -> None:
+        with self._lock:
+            self._depth += 1
+            if self._ops is None:
+                self._ops = OrderedDict()
+
+    def commit(self) -> None:
+        with self._lock:
+            self._depth -= 1
+            if self._depth:
+                return
+            ops, self._ops = self._ops, None
+            if ops:
+                self._commit(ops)
+
+    def write(self, path: str, content: str) -> None:
+        with self._lock:
+            if self._ops is None:
+                self._apply(path, content)
+            else:
+                self._ops[path] = content
+                self._ops.move_to_end(path)
+
+    def delete(self, path: str) -> None:
+        self.write(path, None)
+
+    @staticmethod
+    def _apply(path: str, content: Optional[str]) -> None:
+        if content is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with open(f'{path}.tmp', 'w', encoding='utf8') as fd:
+            fd.write(content)
+        os.replace(f'{path}.tmp', path)
+
+    @staticmethod
+    def _sync_dir(dir: str) -> None:
+        """Makes the renames and removals in the directory durable."""
+        try:
+            dir_fd = os.open(dir or '.', os.O_RDONLY)
+        except OSError:
+            return  # directories can't be opened on Windows, nor synced
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _locked(self) -> FileLock:
+        """Locks the journal against other processes."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        return FileLock(self.lock_path)
+
+    def _commit(self, ops: OrderedDict) -> None:
+        with self._locked():
+            with open(self.path, 'w', encoding='utf8') as journal_fd:
+                for path, content in ops.items():
+                    journal_fd.write(json.dumps({'path': path, 'content': content}) + '\n')
+                journal_fd.write(json.dumps(COMMIT_MARKER) + '\n')
+                journal_fd.flush()
+                os.fsync(journal_fd.fileno())
+            self._replay(ops)
+        logging.debug(f'M: Committed {len(ops)} file changes at once.')
+
+    def _replay(self, ops: OrderedDict) -> None:
+        for path, content in ops.items():
+            self._apply(path, content)
+        # the journal is the durable record until the directories are synced, replaying it is idempotent
+        for dir in {os.path.dirname(path) for path in ops}:
+            self._sync_dir(dir)
+        os.remove(self.path)
+
+    def recover(self) -> None:
+        """Finishes a group commit interrupted by a crash."""
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            with self._locked():
+                self._recover()
+
+    def _recover(self) -> None:
+        # another process could have finished the commit while the lock was awaited
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf8') as journal_fd:
+            records = [json.loads(line) for line in journal_fd if line.endswith('\n')]
+        if not records or records[-1] != COMMIT_MARKER:
+            logging.warning(f'M: Dropping an incomplete journal {self.path}.')
+            os.remove(self.path)
+            return
+        logging.warning(f'M: Applying the journal {self.path} left by an interrupted commit.')
+        self._replay(OrderedDict((record['path'], record['content']) for record in records[:-1]))
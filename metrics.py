@@ -0,0 +1,249 @@
+import os
+import json
+import atexit
+import time
+import bisect
+import logging
+import threading
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+ENV_METRICS_VARNAME = 'AMMETRICS'
+ENV_METRICS_DUMP_VARNAME = 'AMMETRICS_DUMP'
+ENV_METRICS_DUMP_SECS_VARNAME = 'AMMETRICS_DUMP_SECS'
+ENV_METRICS_PORT_VARNAME = 'AMMETRICS_PORT'
+
+DEFAULT_DUMP_SECS = 60
+
+METRICS_HOST = '127.0.0.1'
+
+# upper bounds of the histogram buckets, in milliseconds; the last bucket is unbounded
+BUCKET_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+enabled = os.environ.get(ENV_METRICS_VARNAME) is not None
+
+
+class Histogram:
+
+    """Counts durations in fixed buckets, together with their sum, minimum and maximum."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = None
+        self.max_ms = None
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+
+    def observe(self, ms: float) -> None:
+        self.count += 1
+        self.total_ms += ms
+        self.min_ms = ms if self.min_ms is None else min(self.min_ms, ms)
+        self.max_ms = ms if self.max_ms is None else max(self.max_ms, ms)
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, ms)] += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Returns the upper bound of the bucket the quantile falls into, the maximum for the last one."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max_ms), 3)
+        return round(self.max_ms, 3)
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else None,
+            'min_ms': self.min_ms and round(self.min_ms, 3),
+            'max_ms': self.max_ms and round(self.max_ms, 3),
+            'p50_ms': self.quantile(0.5),
+            'p95_ms': self.quantile(0.95),
+            'buckets': dict(zip([*map(str, BUCKET_BOUNDS_MS), 'inf'], self.buckets)),
+        }
+
+
+class Registry:
+
+    """Stage timings and counters of the process."""
+
+    def __init__(self):
+        self._timings = {}  # stage -> Histogram
+        self._counters = {}  # name -> int
+        self._lock = threading.Lock()
+        self._started = time.time()
+
+    def observe(self, stage: str, ms: float) -> None:
+        with self._lock:
+            histogram = self._timings.get(stage)
+            if histogram is None:
+                histogram = self._timings[stage] = Histogram()
+            histogram.observe(ms)
+
+    def count(self, name: str, n=1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def reset(self) -> None:
+        with self._lock:
+            self._timings.clear()
+            self._counters.clear()
+            self._started = time.time()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'since': self._started,
+                'at': time.time(),
+                'timings': {stage: histogram.snapshot() for stage, histogram in sorted(self._timings.items())},
+                'counters': dict(sorted(self._counters.items())),
+            }
+
+    def to_text(self) -> str:
+        """Formats the snapshot as lines of 'name value' for a human or a scraper."""
+        snapshot = self.snapshot()
+        lines = []
+        for stage, timing in snapshot['timings'].items():
+            for key in ('count', 'total_ms', 'mean_ms', 'min_ms', 'max_ms', 'p50_ms', 'p95_ms'):
+                lines.append(f'{stage}.{key} {timing[key]}')
+        for name, value in snapshot['counters'].items():
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class _Timer:
+
+    def __init__(self, stage):
+        self.stage = stage
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        registry.observe(self.stage, (time.perf_counter() - self._start) * 1000)
+        if exc_type is not None:
+            registry.count(f'{self.stage}.errors')
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def enable(on=True) -> None:
+    global enabled
+    enabled = on
+
+
+def timer(stage: str):
+    """Returns a context manager that records how long its block takes, a no-op when metrics are disabled."""
+    if not enabled:
+        return _null_timer
+    return _Timer(stage)
+
+
+def timed(stage: str):
+    """Decorates a function to record how long its calls take."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe(stage: str, ms: float) -> None:
+    if enabled:
+        registry.observe(stage, ms)
+
+
+def count(name: str, n=1) -> None:
+    if enabled:
+        registry.count(name, n)
+
+
+def snapshot() -> dict:
+    return registry.snapshot()
+
+
+def dump(path: str) -> None:
+    """Writes the snapshot to a JSON file, replacing it atomically."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f'{path}.tmp', 'w', encoding='utf8') as dump_fd:
+        json.dump(registry.snapshot(), dump_fd, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def start_dumper(path: str, interval_secs=DEFAULT_DUMP_SECS) -> threading.Thread:
+    """Dumps the snapshot to the path every interval on a daemon thread."""
+    def run():
+        while True:
+            time.sleep(interval_secs)
+            try:
+                dump(path)
+            except OSError as e:
+                logging.warning(f'Couldn\'t dump the metrics to {path}: {e}')
+    thread = threading.Thread(target=run, name='metrics-dump', daemon=True)
+    thread.start()
+    return thread
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/json':
+            body, content_type = json.dumps(registry.snapshot()), 'application/json'
+        else:
+            body, content_type = registry.to_text(), 'text/plain; charset=utf-8'
+        data = body.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(f'Metrics request: {format % args}')
+
+
+def serve(port: int, host=METRICS_HOST) -> ThreadingHTTPServer:
+    """Serves the metrics as text (and as JSON at /json) on a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logging.info(f'Serving metrics at http://{host}:{server.server_port}/')
+    return server
+
+
+def start_from_env() -> None:
+    """Starts the periodic dump and the endpoint configured in the environment, if metrics are enabled."""
+    if not enabled:
+        return
+    dump_path = os.environ.get(ENV_METRICS_DUMP_VARNAME)
+    if dump_path:
+        # short runs end before the first periodic dump
+        atexit.register(dump, dump_path)
+        start_dumper(dump_path, float(os.environ.get(ENV_METRICS_DUMP_SECS_VARNAME, DEFAULT_DUMP_SECS)))
+    port = os.environ.get(ENV_METRICS_PORT_VARNAME)
+    if port:
+        serve(int(port))
@@ -1,22 +1,68 @@
 import os
-from os.path import basename
-import subprocess
+import json
+import shutil
+import uuid
+import hashlib
+from functools import partial
 import logging
+import sqlite3
+import threading
+import time
 import abc
-from typing import Tuple, Iterable, Union
-from collections import deque
+from typing import Dict, List, Optional, Set, Tuple, Iterable, Iterator, Union
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from functools import wraps
 
 from pydub import AudioSegment
 
+import metrics
+from cache import decoded_audio_cache, file_stamp, ResultCache
+from concat import (
+    check_cancelled, concat_segments, decode_ahead, decode_parallel, export_audio, export_pcm_stream,
+    concat_pcm_size, iter_concat_pcm, merge_params, probe_stream, shape_segment, stream_copy_concat, worker_pool
+)
+from ingest import (
+    analyze_audio, ingest_file, AUDIO_EXTS, CANONICAL_EXT, CONTENT_HASH_KEY, DURATION_KEY, GAIN_KEY,
+    PCM_KEY, SOURCE_HASH_KEY, SOURCE_KEY, TRIM_KEY
+)
+from blobs import BlobStore
+from journal import FileJournal
+from pcmstore import PcmStore, PcmSlice
+
 
 ENTRY_EXT = '.amf'
 
 ENTRIES_FOLDER_PATH = 'res'
 
+CACHE_FOLDER_PATH = os.path.join(ENTRIES_FOLDER_PATH, '.cache')
+
+MANIFEST_PATH = os.path.join(ENTRIES_FOLDER_PATH, 'entries.db')
+
+JOURNAL_PATH = os.path.join(ENTRIES_FOLDER_PATH, '.journal')
+
+# marks an entries folder whose entry files are all named after the entries in them
+ENTRY_FILES_VERSION_FILE_NAME = '.entries_version'
+ENTRY_FILES_VERSION = 1
+
+RESULTS_FOLDER_PATH = os.path.join(CACHE_FOLDER_PATH, 'results')
+
+PCM_STORE_PATH = os.path.join(ENTRIES_FOLDER_PATH, '.pcm', 'entries.pcm')
+
+BLOBS_FOLDER_PATH = os.path.join(ENTRIES_FOLDER_PATH, '.blobs')
+
+INGEST_WORKERS = os.cpu_count() or 1
+
 PAUSE_SECS = 2
 
 
+result_cache = ResultCache(RESULTS_FOLDER_PATH)
+
+pcm_store = PcmStore(PCM_STORE_PATH)
+
+blob_store = BlobStore(BLOBS_FOLDER_PATH, CANONICAL_EXT)
+
+
 class AudioEntry(metaclass=abc.ABCMeta):
 
     """An interface that represents an audio entry."""
@@ -60,28 +106,92 @@ class AudioEntry(metaclass=abc.ABCMeta):
         raise NotImplementedError
 
 
+def load_entry_pcm(entry: AudioEntry) -> Union[PcmSlice, None]:
+    """Returns a zero-copy slice of the entry's PCM if it's packed into the PCM store."""
+    pcm_key = getattr(entry, 'meta', {}).get(PCM_KEY)
+    if not pcm_key:
+        return None
+    pcm = pcm_store.get(pcm_key)
+    if not pcm:
+        logging.warning(f'M: PCM of {entry} is missing from the store, decoding its audio.')
+    return pcm
+
+
+def load_entry_audio(entry: AudioEntry) -> AudioSegment:
+    """Loads audio of an entry from the PCM store or by decoding its audio file."""
+    pcm = load_entry_pcm(entry)
+    if pcm:
+        return pcm.to_audio_segment()
+    return decoded_audio_cache.get(entry.audio_path)
+
+
+def entry_shaping(entry: AudioEntry) -> Tuple[Union[list, None], float]:
+    """Returns the trim offsets and the gain precomputed for the entry at ingest."""
+    meta = getattr(entry, 'meta', {})
+    return meta.get(TRIM_KEY), meta.get(GAIN_KEY, 0.0)
+
+
+def entry_shaped(entry: AudioEntry) -> bool:
+    """Tells whether the shaping of the entry changes its audio, i.e. the trim cuts some or there is gain."""
+    trim, gain = entry_shaping(entry)
+    if gain:
+        return True
+    if not trim:
+        return False
+    if trim[0] > 0:
+        return True
+    duration = getattr(entry, 'meta', {}).get(DURATION_KEY)
+    if duration is None:
+        # entries analyzed before the duration was stored
+        pcm = load_entry_pcm(entry)
+        if not pcm:
+            return True
+        duration = len(pcm.raw_data) * 1000 // (pcm.frame_rate * pcm.channels * pcm.sample_width)
+    return trim[1] < duration
+
+
 class RawTextAudioEntry(AudioEntry):
 
     """An audio entry that is stored in a raw text file."""
     # TODO the strange thing is that it if the file is not in the default directory it will be created
 
-    def __init__(self, name, audio_path, dir=ENTRIES_FOLDER_PATH):
+    def __init__(self, name, audio_path, dir=ENTRIES_FOLDER_PATH, entry_path=None, meta=None, journal=None):
         self.dir = dir
-        self._entry_path = None
+        self._entry_path = entry_path
         self.name = name
         self.audio_path = audio_path
+        self.meta = meta or {}
+        self.journal = journal  # writes the entry file as a part of a group commit
 
-    def save(self) -> None:
+    def entry_path(self) -> str:
         if not self._entry_path:
             self._entry_path = os.path.join(self.dir, f'{self.name}{ENTRY_EXT}')
-        with open(self._entry_path, 'w', encoding='utf8') as entry_fd:
-            entry_fd.writelines((
-                f'{self.name}\n',
-                os.path.relpath(self.audio_path)
-            ))
+        return self._entry_path
+
+    def save(self) -> None:
+        content = '\n'.join((
+            self.name,
+            os.path.relpath(self.audio_path),
+            *(f'{key}={json.dumps(value)}' for key, value in self.meta.items())
+        ))
+        if self.journal:
+            self.journal.write(self.entry_path(), content)
+            return
+        with open(self.entry_path(), 'w', encoding='utf8') as entry_fd:
+            entry_fd.write(content)
             entry_fd.truncate()
 
+    def delete(self) -> None:
+        """Deletes the entry file."""
+        if self.journal:
+            self.journal.delete(self.entry_path())
+        elif os.path.exists(self.entry_path()):
+            os.remove(self.entry_path())
+
     def set_name(self, name: str) -> None:
+        # keep the file named after the entry, lazy collections look entries up by file names
+        self.delete()
+        self._entry_path = os.path.join(self.dir, f'{name}{ENTRY_EXT}')
         self.name = name
         self.save()
 
@@ -91,11 +201,174 @@ class RawTextAudioEntry(AudioEntry):
     def __str__(self) -> str:
         return self.name
 
+    @metrics.timed('entry.load_audio')
+    def load_audio(self) -> Tuple[AudioSegment, int]:
+        audio = load_entry_audio(self)
+        return audio, audio.frame_rate
+
+
+def importable_audio(file_name: str) -> bool:
+    """Checks whether a file in the entries folder is audio that can become an entry."""
+    # concatenated audio is named by joining entry names with commas,
+    # unfinished conversions are named like entry.m4a.tmp.m4a
+    return (os.path.splitext(file_name)[1].lower() in AUDIO_EXTS
+            and ',' not in file_name and '.tmp' not in file_name)
+
+
+def scan_dir(dir: str) -> Dict[str, Tuple[int, int, int]]:
+    """Returns (mtime, size, inode) of every file in the directory by its name."""
+    stamps = {}
+    with os.scandir(dir) as it:
+        for dir_entry in it:
+            if dir_entry.is_file():
+                st = dir_entry.stat()
+                stamps[dir_entry.name] = (st.st_mtime_ns, st.st_size, dir_entry.inode())
+    return stamps
+
+
+def read_entry_file(entry_path: str) -> Tuple[str, str, dict]:
+    """Reads the name, the audio path and the metadata of an entry stored in a raw text file."""
+    with open(entry_path, encoding='utf8') as entry_fd:
+        name = next(entry_fd).strip()
+        audio_path = next(entry_fd).strip()
+        meta = {}
+        for line in entry_fd:
+            key, _, value = line.rstrip('\n').partition('=')
+            if key:
+                meta[key] = json.loads(value)
+    return name, audio_path, meta
+
+
+class SqliteAudioEntry(AudioEntry):
+
+    """An audio entry that is stored as a row of an SQLite manifest."""
+
+    def __init__(self, manifest, name, audio_path, meta=None):
+        self.manifest = manifest
+        self.name = name
+        self.audio_path = audio_path
+        self.meta = meta or {}
+
+    def save(self) -> None:
+        self.manifest.put(self.name, self.audio_path, self.meta)
+
+    def set_name(self, name: str) -> None:
+        self.manifest.rename(self.name, name)
+        self.name = name
+
+    def get_name(self) -> str:
+        return self.name
+
+    def __str__(self) -> str:
+        return self.name
+
+    @metrics.timed('entry.load_audio')
     def load_audio(self) -> Tuple[AudioSegment, int]:
-        audio = AudioSegment.from_file(self.audio_path)
+        audio = load_entry_audio(self)
         return audio, audio.frame_rate
 
 
+class SqliteManifest:
+
+    """A single-file index of audio entries."""
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._deferred = None  # statements of the group being committed
+        self._depth = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'name TEXT PRIMARY KEY, '
+                'audio_path TEXT NOT NULL, '
+                'meta TEXT NOT NULL DEFAULT \'{}\')'
+            )
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(entries)')]
+            if 'meta' not in columns:
+                self._conn.execute('ALTER TABLE entries ADD COLUMN meta TEXT NOT NULL DEFAULT \'{}\'')
+
+    def version(self) -> int:
+        """Returns the schema version of the manifest, 0 for a fresh one."""
+        with self._lock:
+            return self._conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def set_version(self, version: int) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(f'PRAGMA user_version = {int(version)}')
+
+    def names(self) -> Iterable[str]:
+        """Returns the names of all the entries."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute('SELECT name FROM entries')]
+
+    def get(self, name: str) -> Tuple[str, dict]:
+        """Returns the audio path and the metadata of the entry."""
+        with self._lock:
+            row = self._conn.execute('SELECT audio_path, meta FROM entries WHERE name = ?', (name, )).fetchone()
+        if not row:
+            raise KeyError(name)
+        return row[0], json.loads(row[1])
+
+    def entries(self) -> Iterable[Tuple[str, str, dict]]:
+        """Returns (name, audio path, metadata) of all the entries."""
+        with self._lock:
+            rows = self._conn.execute('SELECT name, audio_path, meta FROM entries').fetchall()
+        return [(name, audio_path, json.loads(meta)) for name, audio_path, meta in rows]
+
+    def begin(self) -> None:
+        """Starts a group of updates that are committed in a single transaction."""
+        with self._lock:
+            self._depth += 1
+            if self._deferred is None:
+                self._deferred = []
+
+    def commit(self) -> None:
+        with self._lock:
+            self._depth -= 1
+            if self._depth:
+                return
+            deferred, self._deferred = self._deferred, None
+            with self._conn:
+                for sql, rows in deferred:
+                    self._conn.executemany(sql, rows)
+
+    def _execute_many(self, sql: str, rows: Iterable[tuple], defer=True) -> None:
+        with self._lock:
+            if defer and self._deferred is not None:
+                self._deferred.append((sql, list(rows)))
+                return
+            with self._conn:
+                self._conn.executemany(sql, rows)
+
+    def put(self, name: str, audio_path: str, meta=None) -> None:
+        self.put_many(((name, audio_path, meta), ))
+
+    def put_many(self, entries: Iterable[Tuple[str, str, dict]], defer=True) -> None:
+        """Inserts or updates (name, audio path, metadata) entries in a single transaction.
+
+        Unless defer is false, the transaction is the one of the current group, if there is a group.
+        """
+        self._execute_many(
+            'INSERT OR REPLACE INTO entries (name, audio_path, meta) VALUES (?, ?, ?)',
+            ((name, os.path.relpath(audio_path), json.dumps(meta or {})) for name, audio_path, meta in entries),
+            defer=defer
+        )
+
+    def delete(self, name: str) -> None:
+        self._execute_many('DELETE FROM entries WHERE name = ?', ((name, ), ))
+
+    def rename(self, name: str, new_name: str) -> None:
+        self._execute_many('UPDATE entries SET name = ? WHERE name = ?', ((new_name, name), ))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
 class EntryExists(Exception):
     def __init__(self, entry_name=None):
         msg = 'Entry with this name already exists' 
@@ -105,52 +378,355 @@ class EntryExists(Exception):
         super().__init__(msg)
 
 
-class AudioCollection(dict, metaclass=abc.ABCMeta):
+class ChangeSet:
 
-    """A collection of audio entries."""
+    """Changes made to a collection by a batch of updates.
+
+    Added and changed entries are known by their current names, removed ones by the names
+    they had before the batch. Renamed maps names before the batch to the current ones.
+    """
 
     def __init__(self):
+        self.added = set()
+        self.removed = set()
+        self.changed = set()
+        self.renamed = {}
+        self.reloaded = False  # anything could have changed
+
+    def __bool__(self) -> bool:
+        return bool(self.reloaded or self.added or self.removed or self.changed or self.renamed)
+
+    def __repr__(self) -> str:
+        return (f'ChangeSet(added={self.added}, removed={self.removed}, changed={self.changed}, '
+                f'renamed={self.renamed}, reloaded={self.reloaded})')
+
+    def _original_name(self, name: str) -> str:
+        return next((old for old, new in self.renamed.items() if new == name), name)
+
+    def add(self, name: str) -> None:
+        if name in self.removed:
+            self.removed.discard(name)
+            self.changed.add(name)
+        else:
+            self.added.add(name)
+
+    def remove(self, name: str) -> None:
+        if name in self.added:
+            self.added.discard(name)
+            return
+        self.changed.discard(name)
+        original_name = self._original_name(name)
+        self.renamed.pop(original_name, None)
+        self.removed.add(original_name)
+
+    def change(self, name: str) -> None:
+        if name not in self.added:
+            self.changed.add(name)
+
+    def rename(self, name: str, new_name: str) -> None:
+        if name in self.added:
+            self.added.discard(name)
+            self.added.add(new_name)
+            return
+        if name in self.changed:
+            self.changed.discard(name)
+            self.changed.add(new_name)
+        original_name = self._original_name(name)
+        if original_name == new_name:
+            self.renamed.pop(original_name, None)
+        else:
+            self.renamed[original_name] = new_name
+
+
+class AudioCollection(dict, metaclass=abc.ABCMeta):
+
+    """A collection of audio entries.
+
+    A lazy collection only reads the index of entry names when created, every entry
+    is read on its first access. Call load() to read and validate all of them.
+
+    A collection that packs audio keeps PCM of the entries it ingests in the memory-mapped
+    PCM store, so concatenating them doesn't need any decoding.
+
+    Updates made inside batch() are persisted together and reported to the callbacks
+    once, as a single ChangeSet.
+    """
+
+    def __init__(self, lazy=False, pack_audio=False):
         dict.__init__(self)
+        self.pack_audio = pack_audio
         self._callbacks = []
-        self.load()
         self._names_selected = deque()
+        self._unloaded = {}  # name -> locator of an entry that wasn't read yet
+        self._unloaded_lock = threading.Lock()
+        self._dir_stamps = None  # file stamps of the entries folder as of the last sync
+        self._names_by_audio = defaultdict(set)  # absolute audio path -> names of the loaded entries using it
+        self._batch_lock = threading.RLock()
+        self._batch_depth = 0
+        self._changes = None  # ChangeSet of the current batch
+        start = time.perf_counter()
+        if lazy:
+            self._load_lazily()
+        else:
+            self.load()
+        self.startup_secs = time.perf_counter() - start
+        logging.debug(f'M: Collection of {len(self)} entries is ready in {self.startup_secs:.3f}s'
+                      f'{" (lazy)" if lazy else ""}.')
 
     class Decorators:
         @classmethod
         def with_callbacks(cls, f):
             @wraps(f)
             def wrapper(*args, **kwds):
-                f(*args, **kwds)
-                logging.debug(f'M: Doing callbacks for {f.__name__}...')
-                # args[0] is self
-                args[0]._do_callbacks()
-                logging.debug('M: Done.')
+                # args[0] is self, the callbacks are done when the outermost batch ends
+                with args[0].batch():
+                    return f(*args, **kwds)
             return wrapper
 
+    @contextmanager
+    def batch(self):
+        """Groups updates of the collection.
+
+        The updates are persisted in a single group commit and the callbacks are done once
+        with all the changes when the outermost batch ends. Yields the ChangeSet of the batch.
+
+        A batch isn't atomic: if it raises halfway, the updates made so far are still
+        committed and reported to the callbacks, since they're already applied in memory
+        and to the audio files.
+        """
+        with self._batch_lock:
+            self._batch_depth += 1
+            if self._batch_depth == 1:
+                self._changes = ChangeSet()
+                self._begin_group()
+            try:
+                yield self._changes
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    changes, self._changes = self._changes, None
+                    self._commit_group()
+                    if changes:
+                        self._do_callbacks(changes)
+
+    def _begin_group(self) -> None:
+        """Starts deferring persistence of the updates."""
+
+    def _commit_group(self) -> None:
+        """Persists the deferred updates at once."""
+
+    def __getitem__(self, name: str) -> AudioEntry:
+        entry = dict.__getitem__(self, name)
+        if entry is None:
+            # entries can be read from concatenation threads of the bot
+            with self._unloaded_lock:
+                entry = dict.__getitem__(self, name)
+                if entry is None:
+                    entry = self._load_entry(name, self._unloaded.pop(name))
+                    dict.__setitem__(self, name, entry)
+                    self._index_audio(name, entry)
+        return entry
+
+    def __setitem__(self, name: str, entry: AudioEntry) -> None:
+        self._unloaded.pop(name, None)
+        dict.__setitem__(self, name, entry)
+        self._index_audio(name, entry)
+
+    def _index_audio(self, name: str, entry: AudioEntry) -> None:
+        """Remembers which file the audio of a loaded entry is, for sync()."""
+        audio_path = getattr(entry, 'audio_path', None)
+        if audio_path:
+            self._names_by_audio[os.path.abspath(audio_path)].add(name)
+
+    def get(self, name: str, default=None):
+        return self[name] if name in self else default
+
+    def pop(self, name: str, *default):
+        if name in self:
+            self[name]  # read an unloaded entry before handing it out
+        return dict.pop(self, name, *default)
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def clear(self) -> None:
+        self._unloaded.clear()
+        self._names_by_audio.clear()
+        dict.clear(self)
+
+    def _load_lazily(self) -> None:
+        """Fills the collection with entry names only."""
+        self.clear()
+        self._unloaded = self._load_index()
+        for name in self._unloaded:
+            dict.__setitem__(self, name, None)
+
+    @abc.abstractmethod
+    def _load_index(self) -> dict:
+        """Returns a mapping from entry names to whatever _load_entry needs to read them."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _load_entry(self, name: str, locator) -> AudioEntry:
+        """Reads an entry found by _load_index."""
+        raise NotImplementedError
+
+    @staticmethod
+    def _check_audio(entry: AudioEntry) -> None:
+        """Warns about an entry whose audio file is missing."""
+        audio_path = getattr(entry, 'audio_path', None)
+        if audio_path and not os.path.exists(audio_path):
+            logging.warning(f'M: Audio file of {entry} is missing: {audio_path}')
+
     @Decorators.with_callbacks
     def add(self, names: Union[str, Iterable[str]], audio_paths: Union[str, Iterable[str]]) -> None:
-        """Adds entries to the collection."""
+        """Adds entries to the collection converting their audio to the canonical format."""
         if type(names) == str:
             assert(type(audio_paths) == str)
-            self._add(names, audio_paths)
-        else:
-            for entry in zip(names, audio_paths):
-                self._add(*entry)
+            names, audio_paths = (names, ), (audio_paths, )
+        for name, audio_path in zip(names, audio_paths):
+            if name in self.keys():
+                raise EntryExists(entry_name=name)
+            self._add(name, *self._ingest(name, audio_path))
+            self._changes.add(name)
+
+    @metrics.timed('ingest.file')
+    def _ingest(self, name: str, audio_path: str, dir=ENTRIES_FOLDER_PATH) -> Tuple[str, dict]:
+        """Converts audio of a new entry to the canonical format in the entries folder.
+
+        Returns the path of the converted audio and the metadata to store in the entry.
+        """
+        _, converted_audio_path, meta = ingest_file(name, audio_path, dir, pcm_store_path=self._pcm_store_path())
+        return self._adopt_audio(name, converted_audio_path, meta), meta
+
+    @staticmethod
+    def _adopt_audio(name: str, audio_path: str, meta: dict) -> str:
+        """Moves converted audio of an entry to the blob store, returns the path the entry uses.
+
+        Entries with the same audio content share a single blob.
+        """
+        return AudioCollection._adopt_many([(name, audio_path, meta)])[0]
+
+    @staticmethod
+    def _adopt_many(ingested: List[Tuple[str, str, dict]]) -> List[str]:
+        """Moves converted audio of many entries to the blob store at once, returns the paths the entries use."""
+        paths = [audio_path for _, audio_path, _ in ingested]
+        blobs = [i for i, (_, _, meta) in enumerate(ingested) if meta.get(CONTENT_HASH_KEY)]
+        blob_paths = blob_store.add_many(
+            (ingested[i][2][CONTENT_HASH_KEY], ingested[i][1], ingested[i][0]) for i in blobs
+        )
+        for i, blob_path in zip(blobs, blob_paths):
+            paths[i] = blob_path
+        return paths
+
+    @staticmethod
+    def _release_audio(name: str, meta: dict, keep_hash=None) -> None:
+        """Drops the reference of an entry to its audio, deleting the audio when no entry uses it."""
+        AudioCollection._release_many([(name, meta, keep_hash)])
+
+    @staticmethod
+    def _release_many(released: List[Tuple[str, dict, Optional[str]]]) -> None:
+        """Drops the references of many entries to their audio at once; keep_hash is the new audio of an entry."""
+        aliases = []
+        for name, meta, keep_hash in released:
+            content_hash = meta.get(CONTENT_HASH_KEY)
+            if content_hash:
+                # the new audio of the entry can be the same content
+                if content_hash != keep_hash:
+                    aliases.append((content_hash, name))
+            elif meta.get(PCM_KEY):
+                pcm_store.discard(meta[PCM_KEY])
+        if aliases:
+            for content_hash in blob_store.release_many(aliases):
+                pcm_store.discard(content_hash)
+
+    def _pcm_store_path(self) -> Union[str, None]:
+        """Returns the path of the PCM store if the collection packs audio."""
+        return pcm_store.path if self.pack_audio else None
+
+    @Decorators.with_callbacks
+    def replace_audio(self, name: str, audio_path: str) -> None:
+        """Replaces audio of an existing entry with a new recording."""
+        entry = self[name]
+        old_meta = entry.meta
+        entry.audio_path, entry.meta = self._ingest(name, audio_path, getattr(entry, 'dir', ENTRIES_FOLDER_PATH))
+        self._index_audio(name, entry)
+        entry.save()
+        self._release_audio(name, old_meta, keep_hash=entry.meta.get(CONTENT_HASH_KEY))
+        result_cache.invalidate((name, ))
+        self._changes.change(name)
+
+    @Decorators.with_callbacks
+    def analyze(self, names: Union[Iterable[str], None] = None) -> None:
+        """Computes the trim offsets and the gain of the named entries (all by default) that lack them."""
+        for name in list(self.keys()) if names is None else names:
+            entry = self[name]
+            if TRIM_KEY in entry.meta:
+                continue
+            entry.meta.update(analyze_audio(entry.load_audio()[0]))
+            entry.save()
+            result_cache.invalidate((name, ))
+            self._changes.change(name)
+
+    @staticmethod
+    def _pack_audio(audio: AudioSegment, pcm_key=None) -> str:
+        """Appends the audio to the PCM store unless it's there already, returns its key."""
+        pcm_key = pcm_key or uuid.uuid4().hex
+        if pcm_key not in pcm_store:
+            pcm_store.put(pcm_key, audio)
+        return pcm_key
+
+    @Decorators.with_callbacks
+    def pack(self, names: Union[Iterable[str], None] = None) -> None:
+        """Packs PCM of the named entries (all by default) into the PCM store."""
+        for name in list(self.keys()) if names is None else names:
+            entry = self[name]
+            if load_entry_pcm(entry):
+                continue
+            # deduplicated audio is packed once under its content hash
+            entry.meta[PCM_KEY] = self._pack_audio(entry.load_audio()[0], entry.meta.get(CONTENT_HASH_KEY))
+            entry.save()
+            self._changes.change(name)
+
+    @staticmethod
+    def compact_pcm() -> None:
+        """Reclaims the space taken by PCM of removed entries in the PCM store."""
+        pcm_store.compact()
 
     @abc.abstractmethod
-    def _add(self, name: str, audio_path: str) -> None:
+    def _add(self, name: str, audio_path: str, meta=None) -> None:
         """Adds an entry to the collection."""
         raise NotImplementedError
 
+    def _add_many(self, entries: Iterable[Tuple[str, str, dict]]) -> None:
+        """Adds (name, audio path, metadata) entries to the collection."""
+        for entry in entries:
+            self._add(*entry)
+
+    def _save_many(self, entries: Iterable[AudioEntry]) -> None:
+        """Saves changed entries to the disk."""
+        for entry in entries:
+            entry.save()
+
     @Decorators.with_callbacks
     def remove(self, names: Union[str, Iterable[str]]) -> None:
         """Removes entries from the collection."""
-        if type(names) == str:
-            self._remove(names)
-        else:
-            for name in names:
-                self._remove(name)
-        self.deselect(names)
+        # names can be the selection itself, which changes below
+        names = [names] if type(names) == str else list(names)
+        for name in names:
+            if name not in self.keys():
+                logging.error(f'M: Trying to remove an item that isn\'t a part of the collection: {name}')
+                continue
+            meta = getattr(self[name], 'meta', {})
+            self._remove(name)
+            self._release_audio(name, meta)
+            if name in self._names_selected:
+                self._names_selected.remove(name)
+            self._changes.remove(name)
+        result_cache.invalidate(names)
 
     @abc.abstractmethod
     def _remove(self, name: str) -> None:
@@ -162,10 +738,15 @@ class AudioCollection(dict, metaclass=abc.ABCMeta):
         """Renames entries in the collection."""
         if type(names) == str:
             assert(type(new_names) == str)
-            self._rename(names, new_names)
-        else:
-            for entry in zip(names, new_names):
-                self._rename(*entry)
+            names, new_names = (names, ), (new_names, )
+        names = list(names)
+        for name, new_name in zip(names, new_names):
+            content_hash = getattr(self[name], 'meta', {}).get(CONTENT_HASH_KEY)
+            self._rename(name, new_name)
+            if content_hash:
+                blob_store.rename(content_hash, name, new_name)
+            self._changes.rename(name, new_name)
+        result_cache.invalidate(names)
 
     @abc.abstractmethod
     def _rename(self, name: str, new_name: str) -> None:
@@ -177,10 +758,111 @@ class AudioCollection(dict, metaclass=abc.ABCMeta):
         """Loads all the entries."""
         raise NotImplementedError
 
-    @abc.abstractmethod
-    def init_audio_dir(self, audio_dir=ENTRIES_FOLDER_PATH) -> None:
-        """Creates disk entries for audio file in audio_dir."""
-        raise NotImplementedError
+    def _ingest_sources(self, audio_dir: str) -> Dict[str, Tuple[str, Union[str, None]]]:
+        """Chooses the file every entry in audio_dir is ingested from.
+
+        Returns a mapping from entry names to the file names and the hashes they had when
+        they were ingested the last time (None if they weren't).
+        """
+        file_names = {}
+        for file_name in sorted(os.listdir(audio_dir)):
+            if importable_audio(file_name) and os.path.isfile(os.path.join(audio_dir, file_name)):
+                file_names.setdefault(os.path.splitext(file_name)[0], []).append(file_name)
+        sources = {}
+        for name, candidates in file_names.items():
+            meta = getattr(self[name], 'meta', {}) if name in self else {}
+            if meta.get(SOURCE_KEY) in candidates:
+                sources[name] = meta[SOURCE_KEY], meta.get(SOURCE_HASH_KEY)
+            else:
+                # the converted audio is already there, so it's the cheapest one to ingest
+                converted = f'{name}{CANONICAL_EXT}'
+                sources[name] = (converted if converted in candidates else candidates[0]), None
+        return sources
+
+    @Decorators.with_callbacks
+    @metrics.timed('ingest.dir')
+    def init_audio_dir(self, audio_dir=ENTRIES_FOLDER_PATH, workers=INGEST_WORKERS) -> dict:
+        """Creates entries for the audio files in audio_dir, converting them with a pool of worker processes.
+
+        Files that haven't changed since they were ingested are skipped, entries of the changed
+        ones get the new audio. Returns the numbers of ingested, skipped and failed files
+        and the throughput.
+        """
+        start = time.perf_counter()
+        sources = self._ingest_sources(audio_dir)
+        jobs = {}
+        # sources converted in place are moved to the blob store, so they're measured beforehand
+        source_sizes = {
+            name: os.path.getsize(os.path.join(audio_dir, file_name)) for name, (file_name, _) in sources.items()
+        }
+        for name, (file_name, known_hash) in sources.items():
+            args = (name, os.path.join(audio_dir, file_name), audio_dir, known_hash, self._pcm_store_path())
+            if workers and workers > 1:
+                jobs[name] = worker_pool(workers).submit(ingest_file, *args)
+            else:
+                jobs[name] = args
+        ingested, failed = [], []
+        for name, job in jobs.items():
+            try:
+                result = job.result() if workers and workers > 1 else ingest_file(*job)
+            except Exception as e:
+                logging.warning(f'M: Couldn\'t ingest {sources[name][0]}: {e}')
+                failed.append(name)
+                continue
+            if result:
+                ingested.append(result)
+        # one pass over the blob refs for all the files
+        ingested = [
+            (name, audio_path, meta)
+            for (name, _, meta), audio_path in zip(ingested, self._adopt_many(ingested))
+        ]
+        added = [entry for entry in ingested if entry[0] not in self]
+        updated = []
+        released = []
+        for name, audio_path, meta in ingested:
+            if name not in self:
+                continue
+            entry = self[name]
+            released.append((name, getattr(entry, 'meta', {}), meta.get(CONTENT_HASH_KEY)))
+            entry.audio_path, entry.meta = audio_path, meta
+            self._index_audio(name, entry)
+            updated.append(entry)
+        self._release_many(released)
+        self._add_many(added)
+        self._save_many(updated)
+        result_cache.invalidate(entry.get_name() for entry in updated)
+        for name, _, _ in added:
+            self._changes.add(name)
+        for entry in updated:
+            self._changes.change(entry.get_name())
+        secs = time.perf_counter() - start
+        source_bytes = sum(source_sizes[name] for name, _, _ in ingested)
+        stats = {
+            'ingested': len(ingested),
+            'added': len(added),
+            'updated': len(updated),
+            'skipped': len(sources) - len(ingested) - len(failed),
+            'failed': failed,
+            'secs': round(secs, 3),
+            'files_per_sec': round(len(ingested) / secs, 1) if secs else 0.0,
+            'mb_per_sec': round(source_bytes / 2 ** 20 / secs, 1) if secs else 0.0,
+        }
+        metrics.count('ingest.ingested', stats['ingested'])
+        metrics.count('ingest.skipped', stats['skipped'])
+        metrics.count('ingest.failed', len(failed))
+        logging.info(f'M: Ingested {stats["ingested"]} files from {audio_dir} in {stats["secs"]}s '
+                     f'({stats["files_per_sec"]} files/s, {stats["mb_per_sec"]} MB/s), '
+                     f'{stats["skipped"]} unchanged, {len(failed)} failed.')
+        return stats
+
+    def _rename_selected(self, name: str, new_name: str) -> None:
+        """Replaces the name in the selection keeping its position."""
+        # renaming entries that aren't selected is fine, e.g. in a batch
+        if name not in self._names_selected:
+            return
+        i = self._names_selected.index(name)
+        self._names_selected.insert(i, new_name)
+        self._names_selected.remove(name)
 
     def _str_selected(self) -> str:
         return '[' + ', '.join(str(entry) for entry in self._names_selected) + ']'
@@ -212,78 +894,460 @@ class AudioCollection(dict, metaclass=abc.ABCMeta):
         """Returns the names of currently selected entries."""
         return self._names_selected
 
-    def concat_audio(self, output_audio_filepath):
-        if len(self._names_selected) < 2:
+    def concat_key(self, names: Iterable[str], output_ext: str) -> Union[str, None]:
+        """Returns a hash identifying concatenated audio of the named entries, None if it can't be made."""
+        digest = hashlib.sha256(f'{PAUSE_SECS}\0{output_ext.lower()}'.encode('utf8'))
+        for name in names:
+            audio_path = getattr(self[name], 'audio_path', None)
+            if not audio_path or not os.path.exists(audio_path):
+                return None
+            mtime, size = file_stamp(audio_path)
+            digest.update(f'\0{name}\0{os.path.abspath(audio_path)}\0{mtime}\0{size}'.encode('utf8'))
+            digest.update(json.dumps(entry_shaping(self[name])).encode('utf8'))
+        return digest.hexdigest()
+
+    def _load_segments(self, names: Iterable[str], workers=None,
+                       progress=None, cancel=None) -> Iterable[Union[AudioSegment, PcmSlice]]:
+        """Loads audio of the named entries.
+
+        Packed entries come as zero-copy slices of the PCM store, the others are decoded,
+        with a pool of workers if there are any. The trim offsets and the gain computed
+        at ingest are applied to every entry. progress is called with ('decode', entries loaded,
+        all the entries), setting the cancel event stops the decoding.
+        """
+        entries = [self[name] for name in names]
+        segments = [load_entry_pcm(entry) for entry in entries]
+        unpacked = [i for i, segment in enumerate(segments) if segment is None]
+        audio_paths = [getattr(entries[i], 'audio_path', None) for i in unpacked]
+        if None in audio_paths:
+            decoded = (entries[i].load_audio()[0] for i in unpacked)
+        elif workers and workers > 1:
+            decoded = decoded_audio_cache.get_many(audio_paths, partial(decode_parallel, workers=workers))
+        else:
+            decoded = (decoded_audio_cache.get(audio_path) for audio_path in audio_paths)
+        loaded = len(entries) - len(unpacked)
+        for i in unpacked:
+            check_cancelled(cancel)
+            with metrics.timer('concat.decode_entry'):
+                segments[i] = next(decoded)
+            loaded += 1
+            if progress:
+                progress('decode', loaded, len(entries))
+        return [shape_segment(segment, *entry_shaping(entry)) for entry, segment in zip(entries, segments)]
+
+    def _iter_segments(self, names: Iterable[str], workers=None,
+                       progress=None, cancel=None) -> Iterator[Union[AudioSegment, PcmSlice]]:
+        """Loads audio of the named entries one by one, shaped like _load_segments() does.
+
+        With workers, the entries are decoded in parallel, at most that many entries ahead.
+        """
+        entries = [self[name] for name in names]
+        packed = [load_entry_pcm(entry) for entry in entries]
+        unpacked = [entry for entry, pcm in zip(entries, packed) if pcm is None]
+        audio_paths = [getattr(entry, 'audio_path', None) for entry in unpacked]
+        if None in audio_paths:
+            decoded = (entry.load_audio()[0] for entry in unpacked)
+        elif workers and workers > 1:
+            decoded = decoded_audio_cache.iter_many(audio_paths, partial(decode_ahead, workers=workers))
+        else:
+            decoded = (decoded_audio_cache.get(audio_path) for audio_path in audio_paths)
+        for loaded, (entry, pcm) in enumerate(zip(entries, packed), 1):
+            check_cancelled(cancel)
+            if pcm is None:
+                with metrics.timer('concat.decode_entry'):
+                    pcm = next(decoded)
+            yield shape_segment(pcm, *entry_shaping(entry))
+            if progress:
+                progress('decode', loaded, len(entries))
+
+    @staticmethod
+    def _entry_params(entry: AudioEntry) -> Union[Tuple[int, int, int], None]:
+        """Returns the (channels, frame_rate, sample_width) of the entry's audio without decoding it, None if unknown."""
+        pcm = load_entry_pcm(entry)
+        if pcm:
+            return pcm.channels, pcm.frame_rate, pcm.sample_width
+        meta = getattr(entry, 'meta', {})
+        if all(key in meta for key in ('channels', 'frame_rate', 'sample_width')):
+            return meta['channels'], meta['frame_rate'], meta['sample_width']
+        audio_path = getattr(entry, 'audio_path', None)
+        stream = audio_path and probe_stream(audio_path)
+        # lossy codecs don't tell the sample width pydub decodes them with
+        if stream and stream[4] in (16, 32):
+            return stream[2], stream[1], stream[4] // 8
+        return None
+
+    @staticmethod
+    def _entry_duration(entry: AudioEntry) -> Union[int, None]:
+        """Returns the duration of the entry's shaped audio in milliseconds without decoding it, None if unknown."""
+        trim, _ = entry_shaping(entry)
+        if trim:
+            return trim[1] - trim[0]
+        duration = getattr(entry, 'meta', {}).get(DURATION_KEY)
+        if duration is not None:
+            return duration
+        pcm = load_entry_pcm(entry)
+        if pcm:
+            return len(pcm.raw_data) * 1000 // (pcm.frame_rate * pcm.channels * pcm.sample_width)
+        return None
+
+    def _stream_size(self, names: Iterable[str], params: Tuple[int, int, int]) -> int:
+        """Estimates the size of the PCM the named entries are streamed as, 0 if it can't be known upfront."""
+        durations = [self._entry_duration(self[name]) for name in names]
+        if None in durations:
+            return 0
+        return concat_pcm_size(durations, params, PAUSE_SECS * 1000)
+
+    def _stream_params(self, names: Iterable[str]) -> Union[Tuple[int, int, int], None]:
+        """Returns the parameters the named entries are concatenated with, None if they can't be known upfront."""
+        params = [self._entry_params(self[name]) for name in names]
+        if None in params:
+            return None
+        return merge_params(params)
+
+    def concat_audio(self, output_audio_filepath, names=None, workers=None, progress=None, cancel=None):
+        """Concatenates audio of the named entries, the selected ones by default.
+
+        With workers, the entries are decoded in parallel by that many processes.
+        When the parameters of the output are known upfront, the entries are decoded
+        one by one and streamed into the encoder, so memory use doesn't grow with the output.
+
+        progress is called with the stage ('decode' or 'encode'), the work done and the work
+        to do. Setting the cancel event (a threading.Event) stops the concatenation, kills
+        the encoder and raises ConcatCancelled.
+        """
+        names = list(self._names_selected if names is None else names)
+        if len(names) < 2:
             logging.error(f'M: Audio concatenation function is called with less than two entries selected. Aborting.')
             return
-        on = AudioSegment.silent(PAUSE_SECS * 1000)
-        result, sr = self[self._names_selected[0]].load_audio()
-        for sample_name in list(self._names_selected)[1:]:
-            audio, sample_sr = self[sample_name].load_audio()
-            if sample_sr != sr:
-                logging.warning(f'M: Audio samples have different sampling rate, writing with the first encountered one.')
-            result += on
-            result += audio
-        # we assume that the path contains extension of 3 letters
-        wav_path = f'{output_audio_filepath[:-4]}.wav'
-        result.export(wav_path, format='wav')
-        subprocess.run(['ffmpeg', '-y', '-i', wav_path, output_audio_filepath], capture_output=True)
-        os.remove(wav_path)
-        logging.debug(f'M: Concatenated audio was written successfully!')
+        key = self.concat_key(names, os.path.splitext(output_audio_filepath)[1])
+        cached_path = key and result_cache.get(key)
+        if cached_path:
+            shutil.copyfile(cached_path, output_audio_filepath)
+            metrics.count('concat.cache_hits')
+            logging.debug(f'M: Concatenated audio was taken from the cache!')
+            return
+        with metrics.timer('concat.total'):
+            self._concat_uncached(output_audio_filepath, names, workers, progress, cancel)
+        if key:
+            result_cache.put(key, output_audio_filepath, names)
+
+    def _concat_uncached(self, output_audio_filepath, names, workers, progress, cancel) -> None:
+        audio_paths = [getattr(self[name], 'audio_path', None) for name in names]
+        # shaped entries have to be decoded
+        shaped = any(entry_shaped(self[name]) for name in names)
+        if None not in audio_paths and not shaped:
+            with metrics.timer('concat.stream_copy'):
+                copied = stream_copy_concat(audio_paths, PAUSE_SECS * 1000, output_audio_filepath, CACHE_FOLDER_PATH)
+            if copied:
+                metrics.count('concat.stream_copies')
+                logging.debug(f'M: Concatenated audio was written successfully without re-encoding!')
+                return
+        params = self._stream_params(names)
+        if params:
+            # decoding and encoding overlap here, so they're timed together
+            with metrics.timer('concat.stream'):
+                segments = self._iter_segments(names, workers, progress=progress, cancel=cancel)
+                chunks = iter_concat_pcm(segments, params, PAUSE_SECS * 1000)
+                export_pcm_stream(
+                    chunks, params, output_audio_filepath,
+                    progress=progress, cancel=cancel, total=self._stream_size(names, params)
+                )
+            metrics.count('concat.streamed')
+            logging.debug(f'M: Concatenated audio was streamed successfully!')
+        else:
+            with metrics.timer('concat.decode'):
+                segments = self._load_segments(names, workers, progress=progress, cancel=cancel)
+            with metrics.timer('concat.assemble'):
+                result = concat_segments(segments, PAUSE_SECS * 1000)
+            with metrics.timer('concat.encode'):
+                export_audio(result, output_audio_filepath, progress=progress, cancel=cancel)
+            metrics.count('concat.in_memory')
+            logging.debug(f'M: Concatenated audio was written successfully!')
+
+    @Decorators.with_callbacks
+    def sync(self, dir=ENTRIES_FOLDER_PATH, import_audio=False) -> Tuple[Set[str], Set[str], Set[str]]:
+        """Applies the changes made to the entries folder since the previous sync.
+
+        Only the files whose mtime, size or inode changed are looked at. Added and changed
+        entries are read lazily. With import_audio, audio files that aren't entries yet become
+        entries, just like init_audio_dir does. Returns the added, removed and changed names.
+        """
+        stamps = scan_dir(dir)
+        previous = self._dir_stamps
+        self._dir_stamps = stamps
+        changed_files = set()  # nothing is known to be changed on the first sync
+        if previous is not None:
+            changed_files = {
+                file_name for file_name, stamp in stamps.items()
+                if file_name in previous and previous[file_name] != stamp
+            }
+        added, removed, changed = self._sync_index(dir, stamps, changed_files)
+        for name in removed:
+            dict.pop(self, name, None)
+            self._unloaded.pop(name, None)
+            if name in self._names_selected:
+                self._names_selected.remove(name)
+        for name, locator in {**added, **changed}.items():
+            self._unloaded[name] = locator
+            dict.__setitem__(self, name, None)
+        # the concatenated audio written next to the entries can't be an entry's audio
+        changed = set(changed) | self._names_of_audio(dir, {
+            file_name for file_name in changed_files if importable_audio(file_name)
+        })
+        added = set(added)
+        if import_audio:
+            for file_name in stamps:
+                name = os.path.splitext(file_name)[0]
+                if importable_audio(file_name) and name not in self.keys():
+                    self._add(name, *self._ingest(name, os.path.join(dir, file_name), dir))
+                    added.add(name)
+        result_cache.invalidate(removed | changed)
+        for name in removed:
+            self._changes.remove(name)
+        for name in added:
+            self._changes.add(name)
+        for name in changed:
+            self._changes.change(name)
+        if added or removed or changed:
+            logging.debug(f'M: Synced {len(added)} added, {len(removed)} removed and {len(changed)} changed entries.')
+        return added, removed, changed
+
+    @abc.abstractmethod
+    def _sync_index(self, dir: str, stamps: dict, changed_files: Set[str]) -> Tuple[dict, Set[str], dict]:
+        """Compares the entries folder with the collection.
+
+        Returns the added entries and the changed ones (both as name -> locator mappings,
+        just like _load_index) and the names of removed entries.
+        """
+        raise NotImplementedError
+
+    def _names_of_audio(self, dir: str, file_names: Set[str]) -> Set[str]:
+        """Returns the names of loaded entries whose audio is one of the files.
+
+        Entries that aren't loaded yet read their audio afresh anyway, so they aren't read here.
+        """
+        names = set()
+        for file_name in file_names:
+            audio_path = os.path.abspath(os.path.join(dir, file_name))
+            for name in list(self._names_by_audio.get(audio_path, ())):
+                entry = dict.get(self, name)
+                # the index isn't cleaned up when entries go or get other audio
+                if entry is None or os.path.abspath(getattr(entry, 'audio_path', '')) != audio_path:
+                    self._names_by_audio[audio_path].discard(name)
+                else:
+                    names.add(name)
+        return names
 
     def add_callback(self, func):
-        """Adds a function that is called after every model update (excluding selection changes)."""
+        """Adds a function that is called with the ChangeSet of every model update (excluding selection changes)."""
         self._callbacks.append(func)
 
-    def _do_callbacks(self):
+    def _do_callbacks(self, changes: ChangeSet):
         """Performs all the callbacks."""
+        logging.debug(f'M: Doing callbacks for {changes}...')
         for func in self._callbacks:
-            func()
+            func(changes)
+        logging.debug('M: Done.')
 
 
 class RawTextAudioCollection(AudioCollection):
 
     """An audio collection that uses entries stored in raw text files."""
 
-    def _add(self, name: str, audio_path: str) -> None:
+    def __init__(self, lazy=False, pack_audio=False, journal_path=JOURNAL_PATH):
+        self.journal = FileJournal(journal_path)
+        super().__init__(lazy=lazy, pack_audio=pack_audio)
+
+    def _begin_group(self) -> None:
+        self.journal.begin()
+
+    def _commit_group(self) -> None:
+        self.journal.commit()
+
+    def _add(self, name: str, audio_path: str, meta=None) -> None:
         if name in self.keys():
             raise EntryExists(entry_name=name)
-        entry = RawTextAudioEntry(name, audio_path)
+        entry = RawTextAudioEntry(name, audio_path, meta=meta, journal=self.journal)
         self[name] = entry
         entry.save()
 
     def _remove(self, name: str) -> None:
-        # TODO logging.error for consistency with deselect?
-        self.pop(name)  # doesn't throw an exception if there is no such entry
+        entry = self.pop(name, None)  # doesn't throw an exception if there is no such entry
+        if entry:
+            entry.delete()
 
     def _rename(self, name: str, new_name: str) -> None:
-        entry = self[name]
+        if new_name in self.keys():
+            raise EntryExists(entry_name=new_name)
+        entry = self.pop(name)
         entry.set_name(new_name)
-        try:
-            i = self._names_selected.index(name)
-            self._names_selected.insert(i, new_name)
-            self._names_selected.remove(name)
-        except ValueError:
-            logging.error(f'M: Item isn\'t selected when renaming: {name}')
+        self[new_name] = entry
+        self._rename_selected(name, new_name)
+
+    @staticmethod
+    def _migrate_entry_files(dir: str) -> None:
+        """Renames entry files to the entries they contain, once per folder.
+
+        Renames used to rewrite the entry in its old file, so the lazy index, which
+        takes the names from the file names, would show the old names.
+        """
+        version_path = os.path.join(dir, ENTRY_FILES_VERSION_FILE_NAME)
+        if os.path.exists(version_path):
+            return
+        for file_name in os.listdir(dir):
+            if not file_name.endswith(ENTRY_EXT):
+                continue
+            entry_path = os.path.join(dir, file_name)
+            name = read_entry_file(entry_path)[0]
+            if name == file_name[:-len(ENTRY_EXT)]:
+                continue
+            new_entry_path = os.path.join(dir, f'{name}{ENTRY_EXT}')
+            if os.path.exists(new_entry_path):
+                logging.warning(f'M: Can\'t rename {entry_path} to {new_entry_path}, there is such a file already.')
+                continue
+            os.replace(entry_path, new_entry_path)
+            logging.info(f'M: Renamed {entry_path} to {new_entry_path} after the entry in it.')
+        with open(version_path, 'w', encoding='utf8') as version_fd:
+            version_fd.write(str(ENTRY_FILES_VERSION))
+
+    @metrics.timed('model.load_index')
+    def _load_index(self, dir=ENTRIES_FOLDER_PATH) -> dict:
+        self.journal.recover()
+        self._migrate_entry_files(dir)
+        # entry files are named after their entries
+        return {
+            entry_path[:-len(ENTRY_EXT)]: os.path.join(dir, entry_path)
+            for entry_path in os.listdir(dir) if entry_path.endswith(ENTRY_EXT)
+        }
+
+    def _load_entry(self, name: str, entry_path: str) -> AudioEntry:
+        entry_name, audio_path, meta = read_entry_file(entry_path)
+        if entry_name != name:
+            logging.warning(f'M: Entry file {entry_path} contains another entry: {entry_name}')
+        return RawTextAudioEntry(entry_name, audio_path, entry_path=entry_path, meta=meta, journal=self.journal)
+
+    def _sync_index(self, dir: str, stamps: dict, changed_files: Set[str]) -> Tuple[dict, Set[str], dict]:
+        records = {
+            file_name[:-len(ENTRY_EXT)]: os.path.join(dir, file_name)
+            for file_name in stamps if file_name.endswith(ENTRY_EXT)
+        }
+        added = {name: entry_path for name, entry_path in records.items() if name not in self.keys()}
+        removed = {name for name in self.keys() if name not in records}
+        changed = {
+            name: entry_path for name, entry_path in records.items()
+            if name in self.keys() and os.path.basename(entry_path) in changed_files
+        }
+        return added, removed, changed
 
     @AudioCollection.Decorators.with_callbacks
+    @metrics.timed('model.load')
     def load(self, dir=ENTRIES_FOLDER_PATH) -> None:
+        self.journal.recover()
+        self._migrate_entry_files(dir)
+        self.clear()
         for entry_path in os.listdir(dir):
             if entry_path.endswith(ENTRY_EXT):
-                with open(os.path.join(dir, entry_path), encoding='utf8') as entry_fd:
-                    name = next(entry_fd).strip()
-                    audio_path = next(entry_fd).strip()
-                entry = RawTextAudioEntry(name, audio_path)
+                entry_path = os.path.join(dir, entry_path)
+                name, audio_path, meta = read_entry_file(entry_path)
+                entry = RawTextAudioEntry(name, audio_path, entry_path=entry_path, meta=meta, journal=self.journal)
+                self._check_audio(entry)
                 self[entry.get_name()] = entry
+        self._changes.reloaded = True
+
+
+class SqliteAudioCollection(AudioCollection):
+
+    """An audio collection that keeps all the entries in a single SQLite manifest."""
+
+    def __init__(self, manifest_path=MANIFEST_PATH, lazy=False, pack_audio=False):
+        self.manifest = SqliteManifest(manifest_path)
+        self._manifest_stamp = None
+        super().__init__(lazy=lazy, pack_audio=pack_audio)
+
+    def _begin_group(self) -> None:
+        self.manifest.begin()
+
+    def _commit_group(self) -> None:
+        self.manifest.commit()
+
+    def _add(self, name: str, audio_path: str, meta=None) -> None:
+        if name in self.keys():
+            raise EntryExists(entry_name=name)
+        entry = SqliteAudioEntry(self.manifest, name, audio_path, meta)
+        self[name] = entry
+        entry.save()
+
+    def _remove(self, name: str) -> None:
+        self.pop(name)
+        self.manifest.delete(name)
 
-    def init_audio_dir(self, audio_dir=ENTRIES_FOLDER_PATH) -> None:
-        for audio_path in os.listdir(audio_dir):
-            if audio_path.endswith('m4a') and ',' not in audio_path:
-                base_name = basename(audio_path)
-                print(f'Basename is {base_name}')
-                audio_path = os.path.join(audio_dir, base_name)
-                print(f'Audio path is {audio_path}')
-                name = os.path.splitext(base_name)[0]
-                print(f'Name is {name}')
-                entry = RawTextAudioEntry(name, audio_path)
-                entry.save()
+    def _add_many(self, entries: Iterable[Tuple[str, str, dict]]) -> None:
+        entries = [SqliteAudioEntry(self.manifest, *entry) for entry in entries]
+        for entry in entries:
+            if entry.name in self.keys():
+                raise EntryExists(entry_name=entry.name)
+        for entry in entries:
+            self[entry.name] = entry
+        self._save_many(entries)
+
+    def _save_many(self, entries: Iterable[AudioEntry]) -> None:
+        # a single transaction
+        self.manifest.put_many((entry.name, entry.audio_path, entry.meta) for entry in entries)
+
+    def _rename(self, name: str, new_name: str) -> None:
+        if new_name in self.keys():
+            raise EntryExists(entry_name=new_name)
+        entry = self.pop(name)
+        entry.set_name(new_name)
+        self[new_name] = entry
+        self._rename_selected(name, new_name)
+
+    def migrate(self, dir=ENTRIES_FOLDER_PATH) -> None:
+        """Imports entries stored in raw text files into the manifest."""
+        entries = []
+        for entry_path in os.listdir(dir):
+            if entry_path.endswith(ENTRY_EXT):
+                entries.append(read_entry_file(os.path.join(dir, entry_path)))
+        # the entries are read back right away, so they can't wait for the group commit
+        self.manifest.put_many(entries, defer=False)
+        logging.info(f'M: Migrated {len(entries)} entries to {self.manifest.path}.')
+
+    def _migrate_if_needed(self, dir=ENTRIES_FOLDER_PATH) -> None:
+        if self.manifest.version() < SqliteManifest.SCHEMA_VERSION:
+            self.migrate(dir)
+            self.manifest.set_version(SqliteManifest.SCHEMA_VERSION)
+
+    @metrics.timed('model.load_index')
+    def _load_index(self, dir=ENTRIES_FOLDER_PATH) -> dict:
+        self._migrate_if_needed(dir)
+        return dict.fromkeys(self.manifest.names())
+
+    def _load_entry(self, name: str, locator=None) -> AudioEntry:
+        return SqliteAudioEntry(self.manifest, name, *self.manifest.get(name))
+
+    def _sync_index(self, dir: str, stamps: dict, changed_files: Set[str]) -> Tuple[dict, Set[str], dict]:
+        # entries live in the manifest, so it only has to be read again when it changes
+        manifest_stamp = file_stamp(self.manifest.path)
+        if manifest_stamp == self._manifest_stamp:
+            return {}, set(), {}
+        self._manifest_stamp = manifest_stamp
+        rows = {name: audio_path for name, audio_path, _ in self.manifest.entries()}
+        added = {name: None for name in rows if name not in self.keys()}
+        removed = {name for name in self.keys() if name not in rows}
+        changed = {}
+        for name, audio_path in rows.items():
+            entry = dict.get(self, name)
+            if entry is not None and os.path.abspath(entry.audio_path) != os.path.abspath(audio_path):
+                changed[name] = None
+        return added, removed, changed
+
+    @AudioCollection.Decorators.with_callbacks
+    @metrics.timed('model.load')
+    def load(self, dir=ENTRIES_FOLDER_PATH) -> None:
+        self._migrate_if_needed(dir)
+        self.clear()
+        for name, audio_path, meta in self.manifest.entries():
+            entry = SqliteAudioEntry(self.manifest, name, audio_path, meta)
+            self._check_audio(entry)
+            self[name] = entry
+        self._changes.reloaded = True
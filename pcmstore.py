@@ -0,0 +1,245 @@
+import os
+import json
+import mmap
+import logging
+import threading
+from typing import NamedTuple, Optional
+
+try:
+    import fcntl
+except ImportError:  # not on POSIX
+    fcntl = None
+
+import numpy as np
+from pydub import AudioSegment
+
+
+INDEX_EXT = '.idx'
+
+LOCK_EXT = '.lock'
+
+# NumPy sample types of pydub's PCM by sample width
+SAMPLE_TYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+class PcmSlice(NamedTuple):
+
+    """Raw PCM that quacks like an AudioSegment as far as concatenation is concerned."""
+
+    raw_data: memoryview
+    channels: int
+    frame_rate: int
+    sample_width: int
+
+    def samples(self) -> np.ndarray:
+        """Returns a zero-copy array of the samples."""
+        return np.frombuffer(self.raw_data, dtype=SAMPLE_TYPES[self.sample_width])
+
+    def to_audio_segment(self) -> AudioSegment:
+        return AudioSegment(
+            data=bytes(self.raw_data),
+            sample_width=self.sample_width,
+            frame_rate=self.frame_rate,
+            channels=self.channels
+        )
+
+
+class FileLock:
+
+    """Holds an exclusive lock on a lock file, so several processes can write to the store."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = open(self.path, 'a')
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._fd.close()
+
+
+class PcmStore:
+
+    """An append-only file of raw PCM of many entries, memory-mapped for reading.
+
+    The index is an append-only log of JSON records next to the data file: a record either
+    places a key at an offset of the data file or removes it. Removed PCM stays in the data
+    file until compact() is called.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = f'{path}{INDEX_EXT}'
+        self.lock_path = f'{path}{LOCK_EXT}'
+        self._index = {}  # key -> (offset, length, channels, frame_rate, sample_width)
+        self._index_read = 0  # bytes of the index log already applied
+        self._index_ino = None
+        self._map = None
+        self._map_ino = None  # inode of the mapped data file
+        self._lock = threading.RLock()
+
+    def _refresh(self) -> None:
+        """Applies index records appended since the last refresh, possibly by other processes."""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as index_fd:
+            ino = os.fstat(index_fd.fileno()).st_ino
+            if ino != self._index_ino:
+                # the store is new or it was compacted, possibly by another process
+                self._index.clear()
+                self._index_read = 0
+                self._index_ino = ino
+                self._map = None
+            index_fd.seek(self._index_read)
+            for line in index_fd:
+                if not line.endswith(b'\n'):
+                    break  # a record that is being written right now
+                self._index_read += len(line)
+                self._apply(json.loads(line))
+
+    def _apply(self, record: dict) -> None:
+        if record.get('removed'):
+            self._index.pop(record['key'], None)
+        else:
+            self._index[record['key']] = (
+                record['offset'], record['length'],
+                record['channels'], record['frame_rate'], record['sample_width']
+            )
+
+    def _remap(self) -> None:
+        """Maps the data file again, e.g. when it grew; views of the old map stay valid."""
+        self._map = None
+        self._map_ino = None
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as data_fd:
+            self._map_ino = os.fstat(data_fd.fileno()).st_ino
+            if os.fstat(data_fd.fileno()).st_size:
+                self._map = mmap.mmap(data_fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _stale(self) -> bool:
+        """Tells whether another process replaced the index or the data file since they were read."""
+        try:
+            if os.stat(self.index_path).st_ino != self._index_ino:
+                return True
+            return self._map is not None and os.stat(self.path).st_ino != self._map_ino
+        except FileNotFoundError:
+            return self._index_ino is not None
+
+    def _sync(self, remap=False) -> None:
+        """Reads the new index records and maps the data file, consistently with each other."""
+        if not os.path.exists(self.index_path):
+            return
+        # compact() replaces both files under the lock, so they can't be caught halfway
+        with FileLock(self.lock_path):
+            self._refresh()
+            if remap or self._map is None or self._map_ino != os.stat(self.path).st_ino:
+                self._remap()
+
+    def _view(self, offset: int, length: int) -> memoryview:
+        if self._map is None or len(self._map) < offset + length:
+            self._remap()
+        return memoryview(self._map)[offset:offset + length]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._index:
+                self._refresh()
+            return key in self._index
+
+    def get(self, key: str) -> Optional[PcmSlice]:
+        """Returns a zero-copy slice of the stored PCM, None if there is no such key."""
+        with self._lock:
+            if key not in self._index or self._stale():
+                self._sync()
+            if key not in self._index:
+                return None
+            offset, length, channels, frame_rate, sample_width = self._index[key]
+            if self._map is None or len(self._map) < offset + length:
+                # the data file grew since it was mapped
+                self._sync(remap=True)
+                if key not in self._index:
+                    return None
+                offset, length, channels, frame_rate, sample_width = self._index[key]
+            if self._map is None or len(self._map) < offset + length:
+                logging.warning(f'M: PCM of {key} is beyond the end of {self.path}.')
+                return None
+            return PcmSlice(memoryview(self._map)[offset:offset + length], channels, frame_rate, sample_width)
+
+    def _append_record(self, record: dict) -> None:
+        with open(self.index_path, 'ab') as index_fd:
+            index_fd.write(json.dumps(record).encode('utf8') + b'\n')
+            index_fd.flush()
+            os.fsync(index_fd.fileno())
+
+    def put(self, key: str, audio: AudioSegment) -> None:
+        """Appends the PCM of the audio under the key."""
+        data = audio.raw_data
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._lock, FileLock(self.lock_path), open(self.path, 'ab') as data_fd:
+            offset = data_fd.seek(0, os.SEEK_END)
+            data_fd.write(data)
+            data_fd.flush()
+            os.fsync(data_fd.fileno())
+            record = {
+                'key': key,
+                'offset': offset,
+                'length': len(data),
+                'channels': audio.channels,
+                'frame_rate': audio.frame_rate,
+                'sample_width': audio.sample_width,
+            }
+            self._append_record(record)
+            self._refresh()
+
+    def discard(self, key: str) -> None:
+        """Removes the key, its PCM is reclaimed by compact()."""
+        with self._lock:
+            if key not in self:
+                return
+            with FileLock(self.lock_path):
+                self._append_record({'key': key, 'removed': True})
+                self._refresh()
+
+    def garbage_bytes(self) -> int:
+        """Returns the size of the PCM that compact() would reclaim."""
+        with self._lock:
+            self._refresh()
+            if not os.path.exists(self.path):
+                return 0
+            return os.path.getsize(self.path) - sum(length for _, length, *_ in self._index.values())
+
+    def compact(self) -> None:
+        """Rewrites the store keeping the PCM of live keys only."""
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            with FileLock(self.lock_path):
+                self._refresh()
+                tmp_path = f'{self.path}.tmp'
+                tmp_index_path = f'{self.index_path}.tmp'
+                with open(tmp_path, 'wb') as tmp_fd, open(tmp_index_path, 'wb') as tmp_index_fd:
+                    for key, (offset, length, channels, frame_rate, sample_width) in self._index.items():
+                        record = {
+                            'key': key,
+                            'offset': tmp_fd.tell(),
+                            'length': length,
+                            'channels': channels,
+                            'frame_rate': frame_rate,
+                            'sample_width': sample_width,
+                        }
+                        tmp_fd.write(self._view(offset, length))
+                        tmp_index_fd.write(json.dumps(record).encode('utf8') + b'\n')
+                    for fd in (tmp_fd, tmp_index_fd):
+                        fd.flush()
+                        os.fsync(fd.fileno())
+                reclaimed = os.path.getsize(self.path) - os.path.getsize(tmp_path)
+                os.replace(tmp_path, self.path)
+                os.replace(tmp_index_path, self.index_path)
+                self._refresh()
+        logging.debug(f'M: Compacted {self.path}, {reclaimed} bytes reclaimed.')
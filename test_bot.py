@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from telegram.error import TelegramError
+
+import bot
+import model
+from model import RawTextAudioCollection, RawTextAudioEntry
+
+
+class StubBot:
+
+    """Stands in for telegram.Bot: records what is sent, rejects the file ids it's told to."""
+
+    def __init__(self, rejected_file_ids=()):
+        self.rejected_file_ids = set(rejected_file_ids)
+        self.messages = []
+        self.documents = []  # file ids or the contents of uploaded files
+
+    def send_message(self, chat_id, text):
+        self.messages.append(text)
+
+    def send_document(self, chat_id, document):
+        if isinstance(document, str):
+            if document in self.rejected_file_ids:
+                raise TelegramError(f'Wrong file identifier: {document}')
+            self.documents.append(document)
+            return SimpleNamespace(document=SimpleNamespace(file_id=document))
+        self.documents.append(document.read())
+        return SimpleNamespace(document=SimpleNamespace(file_id=f'file{len(self.documents)}'))
+
+
+class StubConcatCollection(RawTextAudioCollection):
+
+    """Concatenates by joining the audio files' bytes, so no ffmpeg is needed."""
+
+    def __init__(self, *args, **kwargs):
+        self.concatenated = []
+        super().__init__(*args, **kwargs)
+
+    def concat_audio(self, output_audio_filepath, names=None, **kwargs):
+        self.concatenated.append(list(names))
+        with open(output_audio_filepath, 'wb') as output_fd:
+            for name in names:
+                with open(self[name].audio_path, 'rb') as audio_fd:
+                    output_fd.write(audio_fd.read())
+
+
+class BotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.makedirs('res')
+        for name in ('a', 'b'):
+            audio_path = os.path.join('res', f'{name}.m4a')
+            with open(audio_path, 'wb') as audio_fd:
+                audio_fd.write(name.encode('utf8'))
+            RawTextAudioEntry(name, audio_path).save()
+        self.model = StubConcatCollection(lazy=True)
+        self.file_ids = mock.patch.object(bot, 'file_ids', bot.FileIdStore())
+        self.file_ids.start()
+
+    def tearDown(self):
+        self.file_ids.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def make_audio(self, stub_bot, query=('a', 'b')):
+        queue = bot.AudioQueue(self.model, stub_bot, chat_id=1)
+        queue._concat_and_upload(bot.AudioQueueEntry(list(query), self.model))
+        return self.model.concat_key(query, bot.AUDIO_EXT)
+
+
+class FileIdStoreTest(BotTestCase):
+
+    def test_round_trip(self):
+        store = bot.FileIdStore()
+        store.put('key', 'file1')
+        self.assertEqual(bot.FileIdStore().get('key'), 'file1')
+        store.discard('key')
+        self.assertIsNone(bot.FileIdStore().get('key'))
+
+
+class ResendTest(BotTestCase):
+
+    def test_uploads_once_then_resends_by_file_id(self):
+        stub_bot = StubBot()
+        key = self.make_audio(stub_bot)
+        self.assertEqual(stub_bot.documents, [b'ab'])
+        self.assertEqual(bot.file_ids.get(key), 'file1')
+
+        self.make_audio(stub_bot)
+        self.assertEqual(stub_bot.documents, [b'ab', 'file1'])
+        self.assertEqual(len(self.model.concatenated), 1)
+
+    def test_rejected_file_id_is_dropped_and_audio_uploaded(self):
+        key = self.model.concat_key(('a', 'b'), bot.AUDIO_EXT)
+        bot.file_ids.put(key, 'stale')
+        stub_bot = StubBot(rejected_file_ids={'stale'})
+        self.make_audio(stub_bot)
+        self.assertEqual(stub_bot.documents, [b'ab'])
+        self.assertEqual(len(self.model.concatenated), 1)
+        self.assertEqual(bot.file_ids.get(key), 'file1')
+
+    def test_replaced_audio_gets_a_new_key(self):
+        stub_bot = StubBot()
+        key = self.make_audio(stub_bot)
+
+        def ingest_file(name, audio_path, dir, known_hash=None, pcm_store_path=None):
+            converted_audio_path = os.path.join(dir, f'{name}.new.m4a')
+            shutil.copyfile(audio_path, converted_audio_path)
+            return name, converted_audio_path, {}
+
+        with open('recording.flac', 'wb') as recording_fd:
+            recording_fd.write(b'A')
+        with mock.patch.object(model, 'ingest_file', ingest_file):
+            self.model.replace_audio('a', 'recording.flac')
+
+        new_key = self.make_audio(stub_bot)
+        self.assertNotEqual(new_key, key)
+        self.assertEqual(stub_bot.documents, [b'ab', b'Ab'])
+        self.assertEqual(bot.file_ids.get(new_key), 'file2')
+
+
+if __name__ == '__main__':
+    unittest.main()
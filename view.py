@@ -1,6 +1,8 @@
 import tkinter as tk
-from tkinter import filedialog
+from tkinter import filedialog, ttk
+import bisect
 import logging
+from typing import Iterable, List, Optional
 
 from util import *
 
@@ -19,6 +21,10 @@ CONCAT_TITLE = CONCAT_TEXT
 ENTRY_NAME_TEXT = 'Name:'
 NEW_ENTRY_NAME_TEXT = 'New name:'
 ENTRY_PATH_TEXT = 'Audio file path:'
+FILTER_TEXT = 'Filter:'
+CANCEL_TEXT = 'Cancel'
+PROGRESS_LENGTH = 150
+LIST_ROWS = 10
 BROWSE_BUTTON_TEXT = '...'
 ACCEPT_BUTTON_TEXT = 'OK'
 
@@ -109,6 +115,51 @@ class RenameView(tk.Toplevel):
         self.accept_button.pack(side='left')
 
 
+class SortedNames:
+
+    """Names kept sorted, so that their positions and the names with a prefix are found by bisection."""
+
+    def __init__(self, names: Iterable[str] = ()):
+        self._names = sorted(names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __getitem__(self, i):
+        return self._names[i]
+
+    def __contains__(self, name: str) -> bool:
+        return self.index(name) is not None
+
+    def index(self, name: str) -> Optional[int]:
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            return i
+        return None
+
+    def insert(self, name: str) -> int:
+        """Inserts the name, returns its position."""
+        i = bisect.bisect_left(self._names, name)
+        self._names.insert(i, name)
+        return i
+
+    def remove(self, name: str) -> Optional[int]:
+        """Removes the name, returns the position it had, None if there was no such name."""
+        i = self.index(name)
+        if i is not None:
+            del self._names[i]
+        return i
+
+    def with_prefix(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self._names, prefix)
+        # no name with the prefix is sorted after the prefix followed by the largest character
+        end = bisect.bisect_left(self._names, prefix + chr(0x10ffff), start)
+        return self._names[start:end]
+
+
 class MainView(tk.Toplevel):
 
     def __init__(self, master):
@@ -127,8 +178,29 @@ class MainView(tk.Toplevel):
         self.top_left = tk.Frame(self.top_frame)
         self.top_left.pack(side='left', expand=True, fill='both')
 
-        self.entries_listbox = tk.Listbox(self.top_left, selectmode='extended')
-        self.entries_listbox.pack(side='top', anchor='w')
+        self.filter_frame = tk.Frame(self.top_left)
+        self.filter_frame.pack(side='top', anchor='w')
+
+        self.filter_label = tk.Label(self.filter_frame, text=FILTER_TEXT)
+        self.filter_label.pack(side='left')
+
+        self.filter_text_var = tk.StringVar(self.filter_frame)
+        self.filter_entry = tk.Entry(self.filter_frame, textvariable=self.filter_text_var)
+        self.filter_entry.pack(side='left')
+
+        self.list_frame = tk.Frame(self.top_left)
+        self.list_frame.pack(side='top', anchor='w')
+
+        # the listbox holds only the visible rows, the scrollbar moves them over the shown entries
+        self.entries_listbox = tk.Listbox(
+            self.list_frame, selectmode='extended', height=LIST_ROWS, exportselection=False
+        )
+        self.entries_listbox.pack(side='left')
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.entries_listbox.bind(sequence, self._wheel_handler)
+
+        self.entries_scrollbar = tk.Scrollbar(self.list_frame, orient='vertical', command=self._scroll)
+        self.entries_scrollbar.pack(side='left', fill='y')
 
         self.top_right = tk.Frame(self.top_frame)
         self.top_right.pack(side='right', expand=True, fill='both')
@@ -153,19 +225,133 @@ class MainView(tk.Toplevel):
         self.concat_button = tk.Button(self.bot_frame, state=tk.DISABLED, text=CONCAT_TEXT)
         self.concat_button.pack(side='left')
 
+        self.concat_progressbar = ttk.Progressbar(self.bot_frame, length=PROGRESS_LENGTH, maximum=100)
+        self.concat_progressbar.pack(side='left')
+
+        self.cancel_button = tk.Button(self.bot_frame, state=tk.DISABLED, text=CANCEL_TEXT)
+        self.cancel_button.pack(side='left')
+
+        self.concat_status_label = tk.Label(self.bot_frame)
+        self.concat_status_label.pack(side='left')
+
+        self._names = SortedNames()  # all the entries
+        self._names_shown = SortedNames()  # the entries that pass the filter
+        self._prefix = ''
+        self._offset = 0  # position of the first row of the listbox in the shown entries
+        self._rows = []  # names in the rows of the listbox
+        self._selected = set()  # names selected, in or out of the rows
+
     def display(self, entries):
+        """Shows all the entries from scratch."""
+        self._names = SortedNames(entries.keys())
+        self._selected = set()
+        self._offset = 0
+        self._rows = []
+        self._show_filtered()
+
+    def _show_filtered(self):
+        self._read_selection()
+        self._names_shown = SortedNames(self._names.with_prefix(self._prefix))
+        self._offset = 0
+        self._render()
+
+    def _read_selection(self):
+        """Takes the selection of the rows from the listbox, where the user changes it."""
+        selected_rows = set(self.entries_listbox.curselection())
+        for i, name in enumerate(self._rows):
+            if i in selected_rows:
+                self._selected.add(name)
+            else:
+                self._selected.discard(name)
+
+    def _render(self):
+        """Fills the listbox with the rows from the offset."""
+        total = len(self._names_shown)
+        self._offset = max(0, min(self._offset, total - LIST_ROWS))
+        self._rows = self._names_shown[self._offset:self._offset + LIST_ROWS]
         self.entries_listbox.delete(0, tk.END)
-        for entry_name in entries.keys():
-            self.entries_listbox.insert(tk.END, entry_name)
+        if self._rows:
+            self.entries_listbox.insert(tk.END, *self._rows)
+        for i, name in enumerate(self._rows):
+            if name in self._selected:
+                self.entries_listbox.selection_set(i)
+        if total:
+            self.entries_scrollbar.set(self._offset / total, (self._offset + len(self._rows)) / total)
+        else:
+            self.entries_scrollbar.set(0, 1)
+
+    def _scroll_to(self, offset: int):
+        self._read_selection()
+        self._offset = offset
+        self._render()
+
+    def _scroll(self, action, amount, what=None):
+        if action == 'moveto':
+            self._scroll_to(round(float(amount) * len(self._names_shown)))
+        else:
+            step = LIST_ROWS if what == 'pages' else 1
+            self._scroll_to(self._offset + int(amount) * step)
+
+    def _wheel_handler(self, event):
+        if event.num == 4 or event.delta > 0:
+            self._scroll_to(self._offset - 1)
+        else:
+            self._scroll_to(self._offset + 1)
+        return 'break'
+
+    def apply_changes(self, changes):
+        """Updates the sorted names of the removed, added and renamed entries, then only the visible rows."""
+        self._read_selection()
+        for name in (*changes.removed, *changes.renamed.keys()):
+            self._names.remove(name)
+            self._selected.discard(name)
+            i = self._names_shown.remove(name)
+            # the rows above keep their place
+            if i is not None and i < self._offset:
+                self._offset -= 1
+        for name in (*changes.added, *changes.renamed.values()):
+            self._names.insert(name)
+            if name.startswith(self._prefix) and self._names_shown.insert(name) < self._offset:
+                self._offset += 1
+        self._render()
+        logging.debug(f'V: Listbox shows {len(self._names_shown)} of {len(self._names)} entries.')
+
+    def set_filter(self, prefix: str):
+        """Shows only the entries that start with the prefix."""
+        self._prefix = prefix
+        self._show_filtered()
+
+    def is_shown(self, name: str) -> bool:
+        """Returns whether the name is in a row of the listbox, where it can be deselected."""
+        return name in self._rows
+
+    def select_names(self, names: Iterable[str]):
+        """Selects the names, in the rows of the listbox and when they are scrolled to."""
+        for name in names:
+            self._selected.add(name)
+            if name in self._rows:
+                self.entries_listbox.selection_set(self._rows.index(name))
+
+    def show_concat_status(self, text: str, percent: Optional[float] = None, busy=False, pending=0):
+        """Shows the state of the merges; the cancel button is enabled while one is running."""
+        # the running merge is pending too
+        queued = pending - 1 if busy else pending
+        if queued > 0:
+            text += f' ({queued} in the queue)'
+        self.concat_status_label.config(text=text)
+        if percent is not None:
+            self.concat_progressbar.config(value=percent)
+        self.cancel_button.config(state=tk.NORMAL if busy else tk.DISABLED)
 
     def selection(self):
-        return list(map(
-            lambda i: self.entries_listbox.get(i),
-            self.entries_listbox.curselection()
-        ))
+        """Returns the names selected in the rows of the listbox."""
+        self._read_selection()
+        return [self._rows[i] for i in self.entries_listbox.curselection()]
 
     def listbox_select_handler(self):
-        selection_size = len(self.entries_listbox.curselection())
+        self._read_selection()
+        # the selected entries scrolled out of the rows count too
+        selection_size = len(self._selected)
         logging.debug(f'V: Selection size is {selection_size}')
         # remove button logic
         if selection_size >= 1: